@@ -0,0 +1,98 @@
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+import zipfile
+
+
+class ArtifactStore:
+    """
+        Analysis artifacts of all the bugs in a single SQLite file.
+
+        An artifact (e.g., signature_method_map) is keyed by (dataset, bug_id, artifact, version), where version is
+        the version of the extractor that produced it, so results of another extractor are never reused. Each
+        artifact is pickled separately and only loaded when it is requested. Writes of several artifacts happen in
+        one transaction, so a bug is never half written.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        dir_path = os.path.dirname(db_path)
+        if dir_path != "" and not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS artifacts (dataset TEXT NOT NULL, bug_id TEXT NOT NULL, "
+                         "artifact TEXT NOT NULL, version TEXT NOT NULL, data BLOB NOT NULL, created REAL NOT NULL, "
+                         "PRIMARY KEY (dataset, bug_id, artifact, version))")
+
+    def connect(self):
+        # sqlite connections can be shared neither by threads nor by forked processes
+        if getattr(self.local, "conn", None) is None or self.local.pid != os.getpid():
+            self.local.conn = sqlite3.connect(self.db_path, timeout=60)
+            self.local.conn.execute("PRAGMA journal_mode=WAL")
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def put(self, dataset, bug_id, artifact, value, version=""):
+        self.put_many(dataset, bug_id, {artifact: value}, version)
+
+    def put_many(self, dataset, bug_id, artifacts: dict, version=""):
+        rows = [(dataset, bug_id, artifact, version, pickle.dumps(value), time.time())
+                for artifact, value in artifacts.items()]
+        with self.connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def get(self, dataset, bug_id, artifact, version="", default=None):
+        row = self.connect().execute(
+            "SELECT data FROM artifacts WHERE dataset = ? AND bug_id = ? AND artifact = ? AND version = ?",
+            (dataset, bug_id, artifact, version)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(row[0])
+
+    def has(self, dataset, bug_id, artifacts: list, version=""):
+        placeholders = ", ".join(["?"] * len(artifacts))
+        row = self.connect().execute(
+            f"SELECT COUNT(*) FROM artifacts WHERE dataset = ? AND bug_id = ? AND version = ? "
+            f"AND artifact IN ({placeholders})", [dataset, bug_id, version] + list(artifacts)).fetchone()
+        return row[0] == len(set(artifacts))
+
+    def delete(self, dataset, bug_id, artifact=None):
+        with self.connect() as conn:
+            if artifact is None:
+                conn.execute("DELETE FROM artifacts WHERE dataset = ? AND bug_id = ?", (dataset, bug_id))
+            else:
+                conn.execute("DELETE FROM artifacts WHERE dataset = ? AND bug_id = ? AND artifact = ?",
+                             (dataset, bug_id, artifact))
+
+    def import_zip(self, zip_path, version_of):
+        """
+            Imports the pickles of a zipped analysis_output directory (<dataset>/<bug_id>/<artifact>.pickle) without
+            extracting it. version_of maps an artifact name to the version it is stored with.
+        """
+        count = 0
+        with zipfile.ZipFile(zip_path) as zip_file:
+            for name in zip_file.namelist():
+                parts = name.rstrip("/").split("/")
+                if not name.endswith(".pickle") or len(parts) < 3:
+                    continue
+                dataset, bug_id, artifact = parts[-3], parts[-2], parts[-1][:-len(".pickle")]
+                data = zip_file.read(name)
+                with self.connect() as conn:
+                    conn.execute("INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)",
+                                 (dataset, bug_id, artifact, version_of(artifact), data, time.time()))
+                count += 1
+        return count
+
+
+if __name__ == '__main__':
+    import utils
+
+    if len(sys.argv) != 2:
+        print("Usage: python artifact_store.py <analysis_output.zip>")
+        sys.exit(1)
+    imported = utils.get_artifact_store().import_zip(sys.argv[1], utils.get_artifact_version)
+    print(f"Imported {imported} artifacts into {utils.get_artifact_store().db_path}")
@@ -84,6 +84,8 @@ class RepairState(TypedDict):
     repair_result: RepairStateEnum
     prompt_tokens: int
     completion_tokens: int
+    # Other distinct repairs of the same samples, tried in order when the applied one fails
+    candidates: list
 
 
 class AgentState(TypedDict):
@@ -96,6 +98,7 @@ class AgentState(TypedDict):
     failed_test_cases: list[TestCase]
     related_tests: set
     compile_error_info: str
+    patch_applied: bool
     relative_suspicious_paths: list
     key_tokens: dict
     repair_state: RepairState
@@ -118,4 +121,5 @@ class MAgentState(TypedDict):
     fault_files: list[str]
     repair_result: RepairStateEnum
     merged_agents: dict
+    patch_applied: bool
     bug_benchmark: Benchmark
@@ -1,51 +1,129 @@
+import ast
 import jpype
 import utils
 import os
-import multiprocessing
+from collections import OrderedDict
 
 
-def program_analysis_working(queue, root_dir, source_dir, class_dir, fault_loc_file, test_names, test_build_dir):
-    try:
-        jvm_path = jpype.getDefaultJVMPath()
-        javaparser_path = os.path.join(utils.ROOT_PATH, "java_lib", "context-extractor.jar")
-        jpype.startJVM(jvm_path, "-ea", "-Djava.class.path=%s" % javaparser_path)
+# Analyzers kept by each analysis service process, keyed by (root_dir, source_dir, class_dir)
+program_analyzers = OrderedDict()
+MAX_PROGRAM_ANALYZERS = 4
+
+
+def get_program_analyzer(root_dir, source_dir, class_dir):
+    key = (root_dir, source_dir, class_dir)
+    if key in program_analyzers:
+        program_analyzers.move_to_end(key)
+    else:
         ProgramAnalysis = jpype.JClass("ProgramAnalysis")
-        String = jpype.JClass('java.lang.String')
-        programAnalysis = ProgramAnalysis(root_dir, source_dir, class_dir)
-        programAnalysis.faultAnalysis(fault_loc_file, jpype.JArray(String)(test_names), test_build_dir)
-        signature_method_map = programAnalysis.getSignatureSuspiciousMethodMap()
-        # methods_tests_map = programAnalysis.getSuspiciousMethodsToTestsMap()
-        methods_tests_map = programAnalysis.getRelatedSuspiciousMethodsToTestsMap()
-        methods_test_paths_map = programAnalysis.getSuspiciousMethodsToTestPathsMap()
-        queue.put((str(signature_method_map), str(methods_tests_map), str(methods_test_paths_map)))
-        # jpype.shutdownJVM()
-    except Exception as e:
-        queue.put(str(e))
-        raise
-    finally:
-        if jpype.isJVMStarted():
-            jpype.shutdownJVM()
+        program_analyzers[key] = ProgramAnalysis(root_dir, source_dir, class_dir)
+        if len(program_analyzers) > MAX_PROGRAM_ANALYZERS:
+            program_analyzers.popitem(last=False)
+    return program_analyzers[key]
+
+
+def release_program_analyzers_working(root_dir):
+    for key in [key for key in program_analyzers if key[0] == root_dir]:
+        del program_analyzers[key]
+
+
+def release_program_analyzers(root_dir):
+    if utils.analysis_service is not None:
+        utils.analysis_service.broadcast(release_program_analyzers_working, root_dir)
+
+
+# Records streamed by program_analysis_working are {"map": <map name>, "key": ..., "value": ...}, the fields below
+# are the ones the repair pipeline relies on for each map
+SIGNATURE_METHOD_FIELDS = {"file_path": str, "line_begin": int, "line_end": int, "fault_lines": list,
+                           "fault_line_codes": list, "similar_methods": list}
+ANALYSIS_MAPS = ("signature_method_map", "methods_tests_map", "method_test_path_map")
+
+
+def to_python(value):
+    # Converts a value returned by the extractor into JSON-compatible python data
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, jpype.JClass("java.lang.String")):
+        return str(value)
+    if isinstance(value, jpype.JClass("java.lang.Boolean")):
+        return bool(value.booleanValue())
+    if isinstance(value, (jpype.JClass("java.lang.Integer"), jpype.JClass("java.lang.Long"),
+                          jpype.JClass("java.lang.Short"), jpype.JClass("java.lang.Byte"))):
+        return int(value.longValue())
+    if isinstance(value, jpype.JClass("java.lang.Number")):
+        return float(value.doubleValue())
+    if isinstance(value, jpype.JClass("java.util.Map")):
+        return [[to_python(entry.getKey()), to_python(entry.getValue())] for entry in value.entrySet()]
+    if isinstance(value, (jpype.JClass("java.util.Collection"), jpype.JArray)):
+        return [to_python(item) for item in value]
+    # Objects of the extractor render themselves as python literals, in which quotes are escaped as irnlgkjidl
+    return decode_literal(ast.literal_eval(str(value).strip()))
+
+
+def decode_literal(value):
+    if isinstance(value, str):
+        return value.replace("irnlgkjidl", "'")
+    if isinstance(value, dict):
+        return [[decode_literal(key), decode_literal(item)] for key, item in value.items()]
+    if isinstance(value, (list, tuple, set)):
+        return [decode_literal(item) for item in value]
+    return value
+
+
+def to_key(key):
+    # Keys of methods_tests_map are tuples of method signatures
+    return tuple(key) if isinstance(key, list) else key
+
+
+def to_record_dict(value):
+    # Maps are transferred as lists of [key, value] pairs, since JSON objects only have string keys
+    return {to_key(key): item for key, item in value} if isinstance(value, list) else value
+
+
+def check_record(map_name, key, value):
+    if map_name == "signature_method_map":
+        if not isinstance(key, str) or not isinstance(value, dict):
+            raise ValueError(f"Malformed record of {map_name}: {key}")
+        for field, field_type in SIGNATURE_METHOD_FIELDS.items():
+            if not isinstance(value.get(field), field_type):
+                raise ValueError(f"Field {field} of {key} in {map_name} is not a {field_type.__name__}")
+    elif map_name == "methods_tests_map":
+        if not isinstance(key, (str, tuple)) or not isinstance(value, list):
+            raise ValueError(f"Malformed record of {map_name}: {key}")
+    elif map_name == "method_test_path_map":
+        if not isinstance(key, str) or not isinstance(value, str):
+            raise ValueError(f"Malformed record of {map_name}: {key}")
+    else:
+        raise ValueError(f"Unknown analysis map {map_name}")
+
+
+def program_analysis_working(root_dir, source_dir, class_dir, fault_loc_file, test_names, test_build_dir):
+    String = jpype.JClass('java.lang.String')
+    programAnalysis = get_program_analyzer(root_dir, source_dir, class_dir)
+    programAnalysis.faultAnalysis(fault_loc_file, jpype.JArray(String)(test_names), test_build_dir)
+    signature_method_map = programAnalysis.getSignatureSuspiciousMethodMap()
+    # methods_tests_map = programAnalysis.getSuspiciousMethodsToTestsMap()
+    methods_tests_map = programAnalysis.getRelatedSuspiciousMethodsToTestsMap()
+    methods_test_paths_map = programAnalysis.getSuspiciousMethodsToTestPathsMap()
+    for map_name, java_map in zip(ANALYSIS_MAPS, (signature_method_map, methods_tests_map, methods_test_paths_map)):
+        for key, value in to_python(java_map):
+            yield {"map": map_name, "key": key, "value": value}
 
 
 def program_analysis(root_dir, source_dir, class_dir, fault_loc_file, test_names, test_build_dir):
-    queue = multiprocessing.Queue()
-    process = multiprocessing.Process(target=program_analysis_working, args=(queue, root_dir, source_dir,
-                                                                             class_dir, fault_loc_file, test_names,
-                                                                             test_build_dir))
+    analysis_maps = {map_name: {} for map_name in ANALYSIS_MAPS}
     try:
-        process.start()
-        process.join()
-        # signature_method_map, methods_test_map, method_test_path_map = queue.get()
-        # return signature_method_map, methods_test_map, method_test_path_map
-        result = queue.get()
-
-        if isinstance(result, Exception):
-            raise RuntimeError("Program analysis failed") from result
-        return result
-    finally:
-        if process.is_alive():
-            process.terminate()
-        process.close()
+        for record in utils.get_analysis_service().stream(program_analysis_working, root_dir, source_dir, class_dir,
+                                                          fault_loc_file, list(test_names), test_build_dir):
+            key = to_key(record.get("key"))
+            value = record.get("value")
+            if record.get("map") == "signature_method_map":
+                value = to_record_dict(value)
+            check_record(record.get("map"), key, value)
+            analysis_maps[record.get("map")][key] = value
+    except RuntimeError as e:
+        raise RuntimeError("Program analysis failed") from e
+    return tuple(analysis_maps[map_name] for map_name in ANALYSIS_MAPS)
 
 
 def program_analysis_repository(root_dir, source_dir, class_dir, test_build_dir, initial_failing_tests, fault_loc_file):
@@ -57,9 +135,6 @@ def program_analysis_repository(root_dir, source_dir, class_dir, test_build_dir,
             fault_loc_file,
             initial_failing_tests,
             test_build_dir)
-        signature_method_map = eval(signature_method_map.strip())
-        methods_tests_map = eval(methods_tests_map.strip())
-        method_test_path_map = eval(method_test_path_map.strip())
         for fault_code_info in signature_method_map.values():
             fault_code_info['file_path'] = os.path.join(source_dir,
                                                         fault_code_info.get('file_path'))
@@ -67,56 +142,81 @@ def program_analysis_repository(root_dir, source_dir, class_dir, test_build_dir,
                 os.path.join(root_dir, fault_code_info['file_path']),
                 fault_code_info.get('line_begin'), fault_code_info.get('line_end'))
             fault_code_info['repaired_code'] = fault_code_info['fault_code']
-            utils.decode_code_list(fault_code_info['similar_methods'])
-            utils.decode_code_list(fault_code_info['fault_line_codes'])
         return signature_method_map, methods_tests_map, method_test_path_map
     except Exception as e:
         raise Exception(str(e))
 
 
-def related_analysis_working(queue, working_dir, source_dir, class_dir, test_names, test_build_dir, fault_file_list):
-    jvm_path = jpype.getDefaultJVMPath()
-    javaparser_path = os.path.join(utils.ROOT_PATH, "java_lib", "context-extractor.jar")
-    jpype.startJVM(jvm_path, "-ea", "-Djava.class.path=%s" % javaparser_path)
-    ProgramAnalysis = jpype.JClass("ProgramAnalysis")
+def related_analysis_working(working_dir, source_dir, class_dir, test_names, test_build_dir, fault_file_list):
     String = jpype.JClass('java.lang.String')
-    programAnalysis = ProgramAnalysis(working_dir, source_dir, class_dir)
+    programAnalysis = get_program_analyzer(working_dir, source_dir, class_dir)
     related_tests = programAnalysis.getMethodsRelatedTests(jpype.JArray(String)(test_names), test_build_dir,
                                                            jpype.JArray(String)(fault_file_list))
-    queue.put([str(item) for item in related_tests])
-    # queue.put(list(related_tests))
-    jpype.shutdownJVM()
+    return [str(item) for item in related_tests]
 
 
 def related_analysis(working_dir, source_dir, class_dir, test_names, test_build_dir, fault_file_list):
-    queue = multiprocessing.Queue()
-    process = multiprocessing.Process(target=related_analysis_working, args=(queue, working_dir, source_dir, class_dir,
-                                                                             test_names, test_build_dir,
-                                                                             fault_file_list))
-    process.start()
-    process.join()
-    process.close()
-    related_tests = queue.get()
-    return related_tests
-
-
-def key_token_mining_working(queue, file_path):
-    jvm_path = jpype.getDefaultJVMPath()
-    javaparser_path = os.path.join(utils.ROOT_PATH, "java_lib", "context-extractor.jar")
-    jpype.startJVM(jvm_path, "-ea", "-Djava.class.path=%s" % javaparser_path)
+    return utils.get_analysis_service().call(related_analysis_working, working_dir, source_dir, class_dir,
+                                             list(test_names), test_build_dir, list(fault_file_list))
+
+
+# Key tokens of a class only depend on its source, they are cached by the content digest of the file
+KEY_TOKENS_DIR = os.path.join(utils.ANALYSIS_DIR, "key_tokens")
+key_tokens_cache = {}
+
+
+def key_token_mining_working(file_paths):
     ProgramAnalysis = jpype.JClass("ProgramAnalysis")
-    signatures = ProgramAnalysis.signaturesMining(file_path)
-    queue.put(str(signatures))
-    # queue.put(list(related_tests))
-    jpype.shutdownJVM()
+    return [str(ProgramAnalysis.signaturesMining(file_path)) for file_path in file_paths]
+
+
+def load_key_tokens(version, digest):
+    file_path = os.path.join(KEY_TOKENS_DIR, version, digest + ".txt")
+    if os.path.exists(file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    return None
+
+
+def save_key_tokens(version, digest, key_tokens):
+    dir_path = os.path.join(KEY_TOKENS_DIR, version)
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+    temp_path = os.path.join(dir_path, f"{digest}.{os.getpid()}.tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(key_tokens)
+    os.replace(temp_path, os.path.join(dir_path, digest + ".txt"))
+
+
+def key_token_mining_batch(working_dir, fault_files):
+    """
+        Mines the key tokens of several files, returns a dict from each fault file to its key tokens.
+
+        Files whose contents were mined before (in this run or a previous one) are served from the cache, and all
+        the remaining files are mined in a single request to the analysis service.
+    """
+    version = utils.get_extractor_version()
+    file_digests = {}
+    missing_files = {}
+    for fault_file in fault_files:
+        if fault_file in file_digests:
+            continue
+        digest = utils.file_digest(os.path.join(working_dir, fault_file))
+        file_digests[fault_file] = digest
+        if (version, digest) in key_tokens_cache:
+            continue
+        key_tokens = load_key_tokens(version, digest)
+        if key_tokens is not None:
+            key_tokens_cache[(version, digest)] = key_tokens
+        elif digest not in missing_files:
+            missing_files[digest] = os.path.join(working_dir, fault_file)
+    if len(missing_files) > 0:
+        results = utils.get_analysis_service().call(key_token_mining_working, list(missing_files.values()))
+        for digest, key_tokens in zip(missing_files.keys(), results):
+            key_tokens_cache[(version, digest)] = key_tokens
+            save_key_tokens(version, digest, key_tokens)
+    return {fault_file: key_tokens_cache[(version, digest)] for fault_file, digest in file_digests.items()}
 
 
 def key_token_mining(working_dir, fault_file):
-    queue = multiprocessing.Queue()
-    file_path = os.path.join(working_dir, fault_file)
-    process = multiprocessing.Process(target=key_token_mining_working, args=(queue, file_path))
-    process.start()
-    process.join()
-    process.close()
-    signatures = queue.get()
-    return signatures
\ No newline at end of file
+    return key_token_mining_batch(working_dir, [fault_file]).get(fault_file)
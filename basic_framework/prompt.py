@@ -1,6 +1,15 @@
+from langchain_core.prompts import ChatPromptTemplate
+
 import utils
+from Config.prompt import PROMPT_TEMPLATE
 from basic_framework.agent_state import AgentState, RepairStateEnum
 
+# Priorities of the context sections, the lowest one is shrunk first when a prompt exceeds its token budget
+TEST_CASES_PRIORITY = 4
+INVOCATION_CHAINS_PRIORITY = 3
+SIMILAR_CODES_PRIORITY = 2
+KEY_TOKENS_PRIORITY = 1
+
 
 def get_fault_programs_pfl_prompt(fault_codes: dict):
     content = "The following codes are buggy:\n"
@@ -14,31 +23,39 @@ def get_fault_programs_pfl_prompt(fault_codes: dict):
     return content
 
 
-def get_test_info_prompt(a_state: AgentState):
+def get_test_info_prompt(a_state: AgentState, limit=None):
+    test_cases = a_state.get('failed_test_cases')[:min(utils.PROVIDED_TEST_CASE_NUM, len(a_state.get('failed_test_cases')))]
+    if limit is not None:
+        test_cases = test_cases[:limit]
     return "".join(
     ["## Failing Test Cases\n",
-     "The codes fail on the following test cases:\n",f"{a_state.get('failed_test_cases')[:min(utils.PROVIDED_TEST_CASE_NUM, len(a_state.get('failed_test_cases')))]}.\n"]
+     "The codes fail on the following test cases:\n",f"{test_cases}.\n"]
     )
 
 
-def get_invocation_chain_prompt(a_state: AgentState):
+def get_invocation_chain_prompt(a_state: AgentState, limit=None):
+    paths = a_state.get('relative_suspicious_paths')
+    if limit is not None:
+        paths = paths[:limit]
     return "".join(
     ["## Dependency Relationships with Test Cases\n"," These are the invocation chains from the failing test cases to the faulty methods. "
                                                      "Consider how changes may affect these relationships to ensure aligned functionality.\n",
-    f"{a_state.get('relative_suspicious_paths')}\n"])
+    f"{paths}\n"])
 
 
-def get_similar_codes_prompt(a_state: AgentState):
+def get_similar_codes_prompt(a_state: AgentState, limit=None):
     content = ""
     similar_code_token = 0
+    similar_code_num = 0
     for fault_signature, fault_code_info in a_state.get('fault_codes').items():
         if len(fault_code_info.get('similar_methods')) != 0:
             content += f"Similar code segments for {fault_signature} are:\n"
             for similar_code in fault_code_info.get('similar_methods'):
-                similar_code_token += utils.cal_token(similar_code)
-                if similar_code_token > 3000:
+                similar_code_token += utils.encoding_count(similar_code)
+                if similar_code_token > utils.SIMILAR_CODES_TOKENS or (limit is not None and similar_code_num >= limit):
                     break
                 content += f"{similar_code}\n"
+                similar_code_num += 1
     if similar_code_token > 0:
         return "".join([
             "## Similar Code Search Results\n",
@@ -48,23 +65,116 @@ def get_similar_codes_prompt(a_state: AgentState):
     return ""
 
 
-def get_key_tokens_prompt(a_state: AgentState):
+def get_key_tokens_prompt(a_state: AgentState, limit=None):
+    key_tokens = a_state.get('key_tokens')
+    if limit is not None:
+        key_tokens = dict(list(key_tokens.items())[:limit])
     return "".join([
         "## Key tokens mined from the Faulty Classes\n",
         "Here are key tokens mined from the faulty classes. Use these as a structural guide and incorporate any "
         "unknown tokens as they may provide useful context for your repair.\n",
-        f"{a_state.get('key_tokens')}\n"])
+        f"{key_tokens}\n"])
+
+
+def get_context_section(name, priority, items, render):
+    # A section of the context that can be shrunk to fewer items (test cases, invocation chains, ...) or dropped
+    return {"name": name, "priority": priority, "items": items,
+            "render": lambda limit: render(limit) if limit > 0 else ""}
+
+
+def get_required_section(name, text):
+    return {"name": name, "priority": None, "items": 1, "render": lambda limit: text}
+
+
+def get_test_info_section(a_state: AgentState):
+    return get_context_section("test cases", TEST_CASES_PRIORITY,
+                               min(utils.PROVIDED_TEST_CASE_NUM, len(a_state.get('failed_test_cases'))),
+                               lambda limit: get_test_info_prompt(a_state, limit))
+
+
+def get_invocation_chain_section(a_state: AgentState):
+    return get_context_section("invocation chains", INVOCATION_CHAINS_PRIORITY,
+                               len(a_state.get('relative_suspicious_paths')),
+                               lambda limit: get_invocation_chain_prompt(a_state, limit))
+
+
+def get_similar_codes_section(a_state: AgentState):
+    return get_context_section("similar codes", SIMILAR_CODES_PRIORITY,
+                               sum(len(fault_code_info.get('similar_methods'))
+                                   for fault_code_info in a_state.get('fault_codes').values()),
+                               lambda limit: get_similar_codes_prompt(a_state, limit))
+
+
+def get_key_tokens_section(a_state: AgentState):
+    return get_context_section("key tokens", KEY_TOKENS_PRIORITY, len(a_state.get('key_tokens')),
+                               lambda limit: get_key_tokens_prompt(a_state, limit))
+
+
+def fit_sections(sections, budget):
+    """
+        Shrinks the context sections, lowest priority first, to half of their items at a time until all the sections
+        fit the token budget, then grows the shrunk sections back as far as they fit, highest priority first.
+        Returns the name, text and tokens of each section.
+    """
+    limits = [section.get("items") for section in sections]
+    tokens = [utils.encoding_count(section.get("render")(limit)) for section, limit in zip(sections, limits)]
+    context_sections = sorted([i for i, section in enumerate(sections) if section.get("priority") is not None],
+                              key=lambda i: sections[i].get("priority"))
+    for i in context_sections:
+        while sum(tokens) > budget and limits[i] > 0:
+            limits[i] //= 2
+            tokens[i] = utils.encoding_count(sections[i].get("render")(limits[i]))
+    # A section shrunk before a section of higher priority may grow again, by halving the gap to its full size
+    for i in reversed(context_sections):
+        low, high = limits[i], sections[i].get("items")
+        while low < high:
+            limit = (low + high + 1) // 2
+            section_tokens = utils.encoding_count(sections[i].get("render")(limit))
+            if sum(tokens) - tokens[i] + section_tokens <= budget:
+                low, limits[i], tokens[i] = limit, limit, section_tokens
+            else:
+                high = limit - 1
+    return [(section.get("name"), section.get("render")(limit), section_tokens)
+            for section, limit, section_tokens in zip(sections, limits, tokens)]
+
+
+def build_prompt_input(role, a_state: AgentState, expert: dict):
+    """
+        Renders the prompt of a role, with the context sections shrunk to fit utils.PROMPT_BUDGET. Returns the prompt
+        input and the tokens of each part of the prompt.
+    """
+    prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+    expert = dict(expert)
+    fault_programs_prompt = get_fault_programs_pfl_prompt(a_state.get("fault_codes"))
+    expert['description'] = fault_programs_prompt
+    expert['expected_output'] = get_output_prompt(role, a_state)
+    base_tokens = utils.encoding_count(prompt.invoke(expert).messages[0].content)
+    role_sections = get_role_sections(role, a_state)
+    budget = utils.PROMPT_BUDGET - base_tokens
+    while True:
+        sections = fit_sections(role_sections, budget)
+        expert['description'] = fault_programs_prompt + "".join(text for _, text, _ in sections)
+        prompt_input = prompt.invoke(expert)
+        # The tokens of the joined texts may differ from the sum of their tokens, the sections are shrunk again
+        overshoot = utils.encoding_count(prompt_input.messages[0].content) - utils.PROMPT_BUDGET
+        if overshoot <= 0 or budget <= 0:
+            break
+        budget -= overshoot
+    section_tokens = {"fault codes and instructions": base_tokens}
+    section_tokens.update({name: tokens for name, _, tokens in sections})
+    return prompt_input, section_tokens
 
 
-def get_role_prompt(role, a_state: AgentState):
+def get_role_sections(role, a_state: AgentState):
+    sections = []
     prompt = ""
     if role == 'fault_analyzer':
         if utils.Test_Case_Prompt:
-            prompt += get_test_info_prompt(a_state)
+            sections.append(get_test_info_section(a_state))
         if utils.Invocation_Chain_Prompt:
-            prompt += get_invocation_chain_prompt(a_state)
+            sections.append(get_invocation_chain_section(a_state))
         if utils.Similar_Codes_Prompt:
-            prompt += get_similar_codes_prompt(a_state)
+            sections.append(get_similar_codes_section(a_state))
         if a_state.get('repair_state').get('repair_result') == RepairStateEnum.NOT_REPAIRED:
             prompt += "".join([
             "Based on the marked suspicious code lines, the provided test cases and the above additional contextual information, analyze these faulty codes step-by-step, examining each piece of code individually.\n "
@@ -73,7 +183,7 @@ def get_role_prompt(role, a_state: AgentState):
             "2. Identify the exact reasons these lines fail to produce the expected results as defined by the test cases.\n",
             "3. Provide a clear and accurate error analysis that precisely pinpoints the root cause of the issues, ensuring that no extraneous modifications or repairs are suggested.\n"])
 
-            return prompt
+            return sections + [get_required_section("instructions", prompt)]
         else:
             if a_state.get('repair_state').get('repair_result') == RepairStateEnum.REPAIR_FORMAT_ERROR:
                 error_prompt = f"The Repair Expert tries to repair the codes. However, Its output have format errors, please let the Repairer Expert to pay attention to the output format.\n"
@@ -84,7 +194,7 @@ def get_role_prompt(role, a_state: AgentState):
                         'repair_code')) + "\n")
                 error_prompt += f"However, the fixed version is still not correct, it encounters the following errors:\n"
                 if a_state.get('repair_state').get('repair_result') == RepairStateEnum.COMPILE_ERROR:
-                    error_prompt += f"Codes have the following compilation error: {a_state.get('compile_error_info')[:min(len(a_state.get('compile_error_info')), 300)]}.\n"
+                    error_prompt += f"Codes have the following compilation error: {a_state.get('compile_error_info')}.\n"
                 elif a_state.get('repair_state').get('repair_result') == RepairStateEnum.REPAIR_EXCEPTION:
                     error_prompt += (
                         f"Codes can be compiled, but during the test phase, it encounters the following exception:\n"
@@ -101,17 +211,17 @@ def get_role_prompt(role, a_state: AgentState):
                 "2. Re-examine the original faulty code based on the failing test cases to identify the root cause.\n"
                 "3. Compare the code before and after the repairs to determine which parts of the fixes were effective and which need further improvement.\n"
                 "4. Provide the improved fault analysis of the original faulty code.\n")
-            return prompt
+            return sections + [get_required_section("history", prompt)]
     if role == 'repairer':
         if not utils.Enable_DualAgent:
             if utils.Test_Case_Prompt:
-                prompt += get_test_info_prompt(a_state)
+                sections.append(get_test_info_section(a_state))
             if utils.Invocation_Chain_Prompt:
-                prompt += get_invocation_chain_prompt(a_state)
+                sections.append(get_invocation_chain_section(a_state))
             if utils.Similar_Codes_Prompt:
-                prompt += get_similar_codes_prompt(a_state)
+                sections.append(get_similar_codes_section(a_state))
             if utils.Key_Token_Prompt:
-                prompt += get_key_tokens_prompt(a_state)
+                sections.append(get_key_tokens_section(a_state))
             if a_state.get('repair_state').get('repair_result') == RepairStateEnum.NOT_REPAIRED:
                 prompt += f"Based on the above contextual information, repair the faulty codes step by step.\n"
             else:
@@ -122,7 +232,7 @@ def get_role_prompt(role, a_state: AgentState):
                 else:
                     error_prompt = ""
                     if a_state.get('repair_state').get('repair_result') == RepairStateEnum.COMPILE_ERROR:
-                        error_prompt = f"Codes have the following compilation error: {a_state.get('compile_error_info')[:min(len(a_state.get('compile_error_info')), 300)]}.\n"
+                        error_prompt = f"Codes have the following compilation error: {a_state.get('compile_error_info')}.\n"
                     elif a_state.get('repair_state').get('repair_result') == RepairStateEnum.REPAIR_EXCEPTION:
                         error_prompt = (
                             f"Codes can be compiled, but during the test phase, it encounters the following exception:\n"
@@ -133,14 +243,18 @@ def get_role_prompt(role, a_state: AgentState):
                         error_prompt = f"It passed all the failed test cases but failed new test cases: \n{a_state.get('failed_test_cases')[:min(utils.PROVIDED_TEST_CASE_NUM, len(a_state.get('failed_test_cases')))]}.\n"
                 prompt = f"\n However, the fixed version is still not correct, with the error info:\n {error_prompt}.\n"
                 prompt += "Please repair again. Let's think step by step.\n"
-            return prompt
+                return [get_required_section("history", prompt)]
+            return sections + [get_required_section("instructions", prompt)]
         else:
             prompt += f"Based on the fault analysis result:\n {a_state.get('repair_state').get('fault_analysis_result')}, repair the faulty codes step by step.\n"
             prompt += f"Steps: Focus on the **suspicious lines** in each faulty method and perform the necessary and essential repair actions with no modifying other lines.\n"
+            sections.append(get_required_section("instructions", prompt))
             if utils.Key_Token_Prompt:
-                prompt += f"Additionally, a list of key tokens mined from the faulty classes are provided, which may provide useful context for your repair:\n {a_state.get('key_tokens')}\n"
-            return prompt
-    return prompt
+                sections.append(get_context_section(
+                    "key tokens", KEY_TOKENS_PRIORITY, len(a_state.get('key_tokens')),
+                    lambda limit: f"Additionally, a list of key tokens mined from the faulty classes are provided, which may provide useful context for your repair:\n {dict(list(a_state.get('key_tokens').items())[:limit])}\n"))
+            return sections
+    return sections
 
 
 def get_output_prompt(role, a_state: AgentState):
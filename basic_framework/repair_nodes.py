@@ -1,6 +1,7 @@
-from langchain_core.prompts import ChatPromptTemplate
+import ast
+import json
 
-from Config.prompt import PROMPT_TEMPLATE, FAULT_ANALYSIS_EXPERT, PROGRAM_REPAIR_EXPERT
+from Config.prompt import FAULT_ANALYSIS_EXPERT, PROGRAM_REPAIR_EXPERT
 from basic_framework.prompt import *
 from utils import modify_files, recover_files, encoding_count
 
@@ -10,12 +11,10 @@ def fault_analyzer(a_state: AgentState):
             or a_state.get('repair_state').get('repair_result') == RepairStateEnum.REPAIR_SUCCESS):
         return a_state
 
-    prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-    fault_analysis_expert = FAULT_ANALYSIS_EXPERT
-    fault_analysis_expert['description'] = get_fault_programs_pfl_prompt(a_state.get("fault_codes")) + get_role_prompt("fault_analyzer", a_state)
-    fault_analysis_expert['expected_output'] = get_output_prompt("fault_analyzer", a_state)
-    prompt_input = prompt.invoke(fault_analysis_expert)
-    if encoding_count(prompt_input.messages[0].content) >= 32768:
+    prompt_input, section_tokens = build_prompt_input("fault_analyzer", a_state, FAULT_ANALYSIS_EXPERT)
+    utils.Repair_Process_Logger.log(f"Prompt tokens by section: {section_tokens}")
+    # Only the fault codes and the instructions are left when the prompt still exceeds the budget
+    if encoding_count(prompt_input.messages[0].content) > utils.PROMPT_BUDGET:
         print("Token too long... Failed to analysis")
         a_state["fault_analysis_success"] = False
         a_state['repair_state']['repair_count'] = utils.MAX_ITERATIONS
@@ -23,7 +22,7 @@ def fault_analyzer(a_state: AgentState):
     print(prompt_input.messages[0].content)
     utils.Repair_Process_Logger.log(prompt_input.messages[0].content)
     # try:
-    response = utils.CUSTOM_MODEL.invoke(prompt_input)
+    response = utils.invoke_llm(prompt_input)
     if response is not None:
         result = response.content
         a_state['repair_state']['fault_analysis_result'] = result[result.find('['):-1]
@@ -41,29 +40,28 @@ def fault_analyzer(a_state: AgentState):
 
 
 def repairer(a_state: AgentState):
-    prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-    program_repair_expert = PROGRAM_REPAIR_EXPERT
-    program_repair_expert['description'] = get_fault_programs_pfl_prompt(a_state.get("fault_codes")) + get_role_prompt("repairer", a_state)
-    program_repair_expert['expected_output'] = get_output_prompt('repairer', a_state)
-    prompt_input = prompt.invoke(program_repair_expert)
+    prompt_input, section_tokens = build_prompt_input("repairer", a_state, PROGRAM_REPAIR_EXPERT)
     print(prompt_input.messages[0].content)
     utils.Repair_Process_Logger.log(prompt_input.messages[0].content)
-    if encoding_count(prompt_input.messages[0].content) >= 32768:
+    utils.Repair_Process_Logger.log(f"Prompt tokens by section: {section_tokens}")
+    if encoding_count(prompt_input.messages[0].content) > utils.PROMPT_BUDGET:
         print("Token too long... Failed to repair")
         a_state['repair_state']['repair_count'] = utils.MAX_ITERATIONS
         return a_state
-    response = utils.CUSTOM_MODEL.invoke(prompt_input)
-    result = response.content
-    utils.Repair_Process_Logger.log(result)
-    print(result)
-    a_state['repair_state']['prompt_tokens'] += response.response_metadata.get('token_usage').get('prompt_tokens')
-    a_state['repair_state']['completion_tokens'] += response.response_metadata.get('token_usage').get('completion_tokens')
-    result = result[result.find("```json"):-1]
-    result = result[result.find('['): result.rfind(']') + 1]
+    results = []
+    for response in utils.invoke_llm_samples(prompt_input, utils.SAMPLES):
+        result = response.content
+        utils.Repair_Process_Logger.log(result)
+        print(result)
+        a_state['repair_state']['prompt_tokens'] += response.response_metadata.get('token_usage').get('prompt_tokens')
+        a_state['repair_state']['completion_tokens'] += response.response_metadata.get('token_usage').get('completion_tokens')
+        result = result[result.find("```json"):-1]
+        results.append(result[result.find('['): result.rfind(']') + 1])
+    result = results[0]
     a_state['repair_state']['repair_history'] = result
+    a_state['repair_state']['candidates'] = []
     try:
-        # result = json.loads(result)
-        result = eval(result)
+        result = parse_repair_result(result)
         if result is not None:
             format_result, format_info = check_repair_codes(result, a_state)
             if format_result:
@@ -83,10 +81,73 @@ def repairer(a_state: AgentState):
         print(str(e))
         utils.Repair_Process_Logger.log("Format Error!\n")
         utils.Repair_Process_Logger.log(str(e))
+    if len(results) > 1:
+        add_candidates(a_state, results)
     a_state['repair_state']['repair_count'] += 1
     return a_state
 
 
+def add_candidates(a_state: AgentState, results):
+    """
+        Keeps the distinct well-formed repairs of the samples as candidates, the cheapest one is applied to the fault
+        codes and the others are tried when it fails to compile or to pass the failed test cases.
+    """
+    candidates = []
+    normalized_candidates = set()
+    for result in results:
+        try:
+            parsed_result = parse_repair_result(result)
+            repaired_codes, _ = get_repaired_codes(parsed_result, a_state)
+        except Exception:
+            continue
+        if repaired_codes is None:
+            continue
+        normalized_candidate = tuple(sorted((key, " ".join(str(code).split())) for key, code in repaired_codes.items()))
+        if normalized_candidate not in normalized_candidates:
+            normalized_candidates.add(normalized_candidate)
+            candidates.append({"repair_history": parsed_result, "repaired_codes": repaired_codes})
+    utils.Repair_Process_Logger.log(f"{len(results)} samples, {len(candidates)} distinct candidates.")
+    if len(candidates) == 0:
+        return
+    # Repairs known to compile come first, repairs known not to compile last
+    candidates.sort(key=lambda candidate: {True: 0, None: 1, False: 2}.get(get_cached_compile_result(a_state,
+                                                                                                     candidate)))
+    apply_candidate(a_state, candidates[0])
+    a_state['repair_state']['repair_result'] = RepairStateEnum.REPAIR_FORMAT_SUCCESS
+    a_state['repair_state']['repair_exception'] = ""
+    a_state['repair_state']['candidates'] = candidates[1:]
+
+
+def get_cached_compile_result(a_state: AgentState, candidate):
+    fault_code_infos = [dict(fault_code_info, repaired_code=candidate.get("repaired_codes").get(
+        key, fault_code_info.get('repaired_code'))) for key, fault_code_info in a_state.get('fault_codes').items()]
+    compile_result = utils.load_validation_result(a_state.get('database_name'), a_state.get('bug_id'), "compile",
+                                                  utils.get_patch_hash(fault_code_infos))
+    return compile_result[0] if compile_result is not None else None
+
+
+def apply_candidate(a_state: AgentState, candidate):
+    for key, repaired_code in candidate.get("repaired_codes").items():
+        a_state.get('fault_codes').get(key)['repaired_code'] = repaired_code
+    a_state['repair_state']['repair_history'] = candidate.get("repair_history")
+
+
+def apply_next_candidate(a_state: AgentState):
+    candidates = a_state.get('repair_state').get('candidates') or []
+    if len(candidates) == 0:
+        return False
+    apply_candidate(a_state, candidates.pop(0))
+    return True
+
+
+def parse_repair_result(result):
+    # The array is usually valid JSON, but models also answer with python literals (single quotes, True/None)
+    try:
+        return json.loads(result)
+    except json.JSONDecodeError:
+        return ast.literal_eval(result)
+
+
 def process(strsss):
     substr = strsss.split("(")[0]
     substr2 = strsss.split("(")[1]
@@ -95,37 +156,73 @@ def process(strsss):
 
 
 def check_repair_codes(result, a_state: AgentState):
+    repaired_codes, format_info = get_repaired_codes(result, a_state)
+    if repaired_codes is None:
+        return False, format_info
+    for key, repaired_code in repaired_codes.items():
+        a_state.get('fault_codes').get(key)['repaired_code'] = repaired_code
+    return True, ""
+
+
+def get_repaired_codes(result, a_state: AgentState):
+    # Maps the keys of the fault codes to their repaired code, or returns None and the format error
+    repaired_codes = {}
     for repaired_code_info in result:
         method_signature = repaired_code_info.get("fault_method_signature")
         if method_signature is None:
             print("Pay attention to the output of fault_method_signature!")
-            return False, "Pay attention to the output of fault_method_signature!"
+            return None, "Pay attention to the output of fault_method_signature!"
         if not method_signature.startswith("<"):
             method_signature = "<" + method_signature
         if not method_signature.endswith(">"):
             method_signature = method_signature + ">"
         method_signature = process(method_signature)
-        fault_code_info = a_state.get('fault_codes').get(method_signature)
+        fault_code_key = method_signature
 
-        if fault_code_info is None:
+        if a_state.get('fault_codes').get(method_signature) is None:
             if len(a_state.get('fault_codes')) > 1:
                 print("Pay attention to the output of fault_method_signature!")
-                return False, "Pay attention to the output of fault_method_signature!"
+                return None, "Pay attention to the output of fault_method_signature!"
             else:
-                fault_code_info = list(a_state.get('fault_codes').values())[0]
+                fault_code_key = list(a_state.get('fault_codes').keys())[0]
         repair_code = repaired_code_info.get("repair_code")
         if repair_code is None:
             print("Pay attention to the output of repair_code!")
-            return False, "Pay attention to the output of repair_code!"
+            return None, "Pay attention to the output of repair_code!"
         if isinstance(repair_code, list):
             repair_code = repair_code[0]
-        fault_code_info['repaired_code'] = repair_code
-    return True, ""
+        repaired_codes[fault_code_key] = repair_code
+    return repaired_codes, ""
 
 
 def modify_and_compile_codes(a_state: AgentState):
-    modify_files(a_state.get('bug_benchmark').get_work_dir(), a_state.get('fault_codes_list'))
-    compile_result, compile_error_info = a_state.get('bug_benchmark').compile_files(a_state.get('fault_files'))
+    compile_codes(a_state)
+    # The other candidates of the same samples are tried before prompting the model again
+    while (a_state['repair_state']['repair_result'] == RepairStateEnum.COMPILE_ERROR and
+           len(a_state.get('repair_state').get('candidates') or []) > 0):
+        recover_codes(a_state)
+        apply_next_candidate(a_state)
+        print("Trying the next candidate repair...")
+        utils.Repair_Process_Logger.log("Trying the next candidate repair...")
+        compile_codes(a_state)
+    return a_state
+
+
+def compile_codes(a_state: AgentState):
+    patch_hash = utils.get_patch_hash(a_state.get('fault_codes').values())
+    compile_result = utils.load_validation_result(a_state.get('database_name'), a_state.get('bug_id'), "compile",
+                                                  patch_hash)
+    a_state['patch_applied'] = compile_result is None
+    if compile_result is None:
+        modify_files(a_state.get('bug_benchmark').get_work_dir(), a_state.get('fault_codes_list'))
+        compile_result = a_state.get('bug_benchmark').compile_files(a_state.get('fault_files'))
+        if utils.is_cacheable_compile_result(compile_result):
+            utils.save_validation_result(a_state.get('database_name'), a_state.get('bug_id'), "compile",
+                                         patch_hash, compile_result)
+    else:
+        print("The repaired codes have been compiled before, reusing the compile result.")
+        utils.Repair_Process_Logger.log("The repaired codes have been compiled before, reusing the compile result.")
+    compile_result, compile_error_info = compile_result
     if compile_result:
         a_state['repair_state']['repair_result'] = RepairStateEnum.COMPILE_SUCCESS
         a_state['compile_error_info'] = ""
@@ -140,7 +237,8 @@ def modify_and_compile_codes(a_state: AgentState):
 
 
 def recover_codes(a_state: AgentState):
-    # recover code
-    recover_files(a_state.get('bug_benchmark').get_work_dir(), a_state.get('fault_files'))
-    a_state.get('bug_benchmark').recover_files(a_state.get('fault_files'))
+    # recover code, unless the compile result was reused without modifying the files
+    if a_state.get('patch_applied', True):
+        recover_files(a_state.get('bug_benchmark').get_work_dir(), a_state.get('fault_files'))
+        a_state.get('bug_benchmark').recover_files(a_state.get('fault_files'))
     return a_state
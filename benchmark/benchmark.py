@@ -1,5 +1,10 @@
+import copy
 import os
 
+import utils
+from benchmark.snapshot_store import copy_tree
+from benchmark.workdir_pool import WorkdirPool
+
 
 class Benchmark:
     def __init__(self, database_name):
@@ -12,6 +17,9 @@ class Benchmark:
         self.test_build_dir = "test_build_dir"
         self.fault_location_file = "fault_location_file"
         self.init_failing_tests = {}
+        self.clones = {}
+        self.class_snapshots = {}
+        self.workdir_pool = None
 
     def checkout(self, bug_id):
         self.bug_id = bug_id
@@ -66,12 +74,108 @@ class Benchmark:
         # return the number of failing tests, and the failing test info
         return 0, test_info
 
+    def test_related_tests(self):
+        # Runs the tests related to the modified classes, returned like test_project, or None if the benchmark
+        # cannot select them
+        return None
+
     def recover_files(self, file_list):
-        self.compile_files(file_list)
+        # The sources are restored by utils.recover_files, their compiled classes are restored from the snapshots
+        # taken before they were first compiled, only files without a snapshot are compiled again
+        self.restore_classes([file for file in file_list if file in self.class_snapshots])
+        missing_files = [file for file in file_list if file not in self.class_snapshots]
+        if len(missing_files) > 0:
+            self.compile_files(missing_files)
+
+    def get_class_dirs(self, file):
+        # Absolute directories the classes compiled from a source file (relative to work_dir) are written to
+        package_dir = os.path.dirname(os.path.relpath(file, self.source_dir))
+        if package_dir.startswith(".."):
+            return []
+        return [os.path.join(self.work_dir, self.build_dir, package_dir)]
+
+    def get_class_files(self, file):
+        class_name = os.path.splitext(os.path.basename(file))[0]
+        class_files = []
+        for class_dir in self.get_class_dirs(file):
+            if os.path.isdir(class_dir):
+                class_files.extend(os.path.join(class_dir, name) for name in os.listdir(class_dir)
+                                   if name == f"{class_name}.class" or
+                                   (name.startswith(f"{class_name}$") and name.endswith(".class")))
+        return class_files
+
+    def snapshot_classes(self, files):
+        # Keeps the contents and times of the classes of the files, taken on the clean checkout (see preprocessor),
+        # compile_files only takes the ones that are still missing
+        for file in files:
+            if file in self.class_snapshots:
+                continue
+            snapshot = {}
+            for class_file in self.get_class_files(file):
+                with open(class_file, 'rb') as f:
+                    snapshot[class_file] = (f.read(), os.stat(class_file).st_mtime_ns)
+            self.class_snapshots[file] = snapshot
+
+    def restore_classes(self, files):
+        for file in files:
+            snapshot = self.class_snapshots.get(file)
+            for class_file in self.get_class_files(file):
+                if class_file not in snapshot:
+                    os.remove(class_file)
+            for class_file, (data, mtime_ns) in snapshot.items():
+                with open(class_file, 'wb') as f:
+                    f.write(data)
+                # Build tools compare the times of sources and classes, the restored source keeps its time as well
+                os.utime(class_file, ns=(mtime_ns, mtime_ns))
 
     def get_all_bugs(self):
         return []
 
+    def clone(self, name):
+        # A copy of the working directory that can be modified and compiled independently of this one
+        if self.clones.get(name) is None:
+            clone_benchmark = copy.copy(self)
+            clone_benchmark.clones = {}
+            clone_benchmark.workdir_pool = None
+            clone_benchmark.work_dir = f"{self.work_dir}-{name}"
+            # The classes of the clean checkout, at the paths of the copy
+            clone_benchmark.class_snapshots = {
+                file: {os.path.join(clone_benchmark.work_dir, os.path.relpath(class_file, self.work_dir)): value
+                       for class_file, value in snapshot.items()}
+                for file, snapshot in self.class_snapshots.items()}
+            utils.remove_temp_dir(clone_benchmark.work_dir)
+            copy_tree(self.work_dir, clone_benchmark.work_dir)
+            self.rebase_clone(clone_benchmark)
+            self.clones[name] = clone_benchmark
+        return self.clones.get(name)
+
+    def rebase_clone(self, clone_benchmark):
+        # Rewrite the fields that contain absolute paths of the original working directory
+        pass
+
+    def get_workdir_pool(self, size):
+        # Clones of the working directory leased to concurrent validators, lease one with workdir_pool.lease() and
+        # give it back with workdir_pool.release(clone, modified_files)
+        if self.workdir_pool is None:
+            self.workdir_pool = WorkdirPool(self, size)
+        else:
+            self.workdir_pool.grow(size)
+        return self.workdir_pool
+
+    def start_services(self):
+        # Start the JVM-backed services of the benchmark (e.g., the compiler), before threads use them
+        pass
+
+    def release_runners(self):
+        # Stop the test runners kept for this working directory and its clones
+        pass
+
+    def remove_clones(self):
+        for clone_benchmark in self.clones.values():
+            utils.remove_temp_dir(clone_benchmark.get_work_dir())
+        self.clones = {}
+        self.workdir_pool = None
+
 
 class BenchmarkRegistry:
     _registry = {}
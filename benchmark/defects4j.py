@@ -3,9 +3,15 @@ import re
 import shutil
 import signal
 import subprocess
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 import utils
 from benchmark.benchmark import Benchmark, BenchmarkRegistry
+from benchmark.java_compiler import COMPILE_TIMEOUT, compile_sources, format_compile_errors, get_compiler_service, \
+    parse_javac_output
+from benchmark.junit_runner import get_junit_service, run_junit_tests, split_into_shards, stop_junit_services
+from benchmark.snapshot_store import SnapshotStore
 from logger import Logger
 
 environment_config = utils.read_json("Config/defects4j_environment.json")
@@ -20,6 +26,25 @@ JAVA8_CMD = (" && ".join([f"export JAVA_HOME=\"{JAVA_8_HOME}\"", "export CLASS_P
 Defects4J_CMD = (" && ".join([JAVA7_CMD, f"export PATH=.$PATH:\"{Defects4J_DIR}/framework/bin\""]))
 Defects4J_V2_CMD = (" && ".join([JAVA8_CMD, f"export PATH=.$PATH:\"{Defects4J_V2_DIR}/framework/bin\""]))
 TEMP_DIR = environment_config["TEMP_DIR"]
+JUNIT_JAR = environment_config.get("JUNIT_JAR", os.path.join(Defects4J_V2_DIR, "framework", "projects", "lib",
+                                                             "junit-4.11.jar"))
+SNAPSHOT_DIR = environment_config.get("SNAPSHOT_DIR", os.path.join(TEMP_DIR, "premm-snapshots"))
+SNAPSHOT_MAX_GB = environment_config.get("SNAPSHOT_MAX_GB", 20)
+snapshot_store = SnapshotStore(SNAPSHOT_DIR, SNAPSHOT_MAX_GB * 1024 ** 3)
+EXPORT_PROPERTIES = ["dir.src.classes", "cp.compile", "dir.bin.classes", "cp.test", "dir.src.tests"]
+EXPORT_MARKER = "PREMM-EXPORT:"
+MULTI_LINE_EXPORTS = {"tests.all"}
+WORK_DIR_PLACEHOLDER = "<work_dir>"
+EXPORTS_ARTIFACT = "defects4j_exports"
+ALL_TESTS_ARTIFACT = "defects4j_all_tests"
+INIT_FAILING_TESTS_ARTIFACT = "init_failing_tests"
+TEST_TIMEOUT = 15
+SHARD_TIMEOUT = 300
+TEST_DURATIONS_ARTIFACT = "test_class_durations"
+JUNIT_ONLY_FAILURES_ARTIFACT = "junit_only_failures"
+# The Java 7 class library, which the Java 8 compiler service compiles the projects of Defects4J v1.2 against
+JAVA_7_BOOT_CLASSPATH = environment_config.get("JAVA_7_BOOT_CLASSPATH", os.path.join(JAVA_7_HOME, "jre", "lib",
+                                                                                     "rt.jar"))
 
 
 @BenchmarkRegistry.register("defects4j")
@@ -27,37 +52,50 @@ class Defects4j(Benchmark):
     def __init__(self, database_name):
         super().__init__(database_name)
         self.compile_jar_path = ""
+        self.test_class_path = ""
 
     def checkout(self, bug_id):
-        self.work_dir = os.path.join(TEMP_DIR, bug_id)
+        self.work_dir = os.path.join(TEMP_DIR, utils.WORKER_TEMP_DIR, bug_id)
         if os.path.exists(self.work_dir):
             shutil.rmtree(self.work_dir)
-        if not os.path.exists(self.work_dir):
+        # A checked out and compiled copy of the bug is reused instead of running checkout and compile again
+        if SNAPSHOT_MAX_GB <= 0 or not snapshot_store.materialize(self.database_name, bug_id, self.work_dir):
             prepare_project(self.database_name, bug_id, self.work_dir)
+            if SNAPSHOT_MAX_GB > 0:
+                snapshot_store.save(self.database_name, bug_id, self.work_dir)
+        self.bug_id = bug_id
+        self.class_snapshots = {}
         self.compile_jar_path, self.source_dir, self.build_dir, self.test_source_dir, self.test_build_dir = (
-            get_necessary_path(self.database_name, self.work_dir))
+            get_necessary_path(self.database_name, self.work_dir, bug_id))
+        self.test_class_path = get_exports(self.database_name, self.work_dir, bug_id)["cp.test"]
         self.fault_location_file = fault_locate(self.database_name, bug_id)
-        try:
-            _, self.init_failing_tests = test_project(self.database_name, bug_id, self.work_dir, self.test_source_dir)
-        except Exception as e:
-            raise Exception("The project failed to init failing test cases (it encounters time out when testing)."
-                            " Please check your project.")
+        # The initial failing tests only depend on the bug, the full test run is skipped when they are known
+        self.init_failing_tests = utils.get_artifact_store().get(self.database_name, bug_id, INIT_FAILING_TESTS_ARTIFACT)
+        if self.init_failing_tests is None:
+            try:
+                _, self.init_failing_tests = test_project(self.database_name, bug_id, self.work_dir,
+                                                          self.test_source_dir)
+            except Exception as e:
+                raise Exception("The project failed to init failing test cases (it encounters time out when testing)."
+                                " Please check your project.")
+            utils.get_artifact_store().put(self.database_name, bug_id, INIT_FAILING_TESTS_ARTIFACT,
+                                           self.init_failing_tests)
 
     def compile_files(self, files: list):
+        self.snapshot_classes(files)
         try:
-            compile_results = compile_files(self.database_name, self.work_dir, self.compile_jar_path, files)
-            result = True
-            compile_error_info = ""
-            if compile_results is not None:
-                for compile_result in compile_results:
-                    if not compile_result.get('compiled_result'):
-                        result = False
-                        compile_error_info += compile_result.get('compiled_info')
-            return result, compile_error_info
+            # The JUnit runner loads the classes from the build directory, which defects4j test would recompile
+            output_dir = self.build_dir if utils.TEST_BACKEND == "junit" else None
+            compile_result = compile_files(self.database_name, self.work_dir, self.compile_jar_path, files,
+                                           output_dir)
+            if compile_result.get("success"):
+                return True, ""
+            return False, format_compile_errors(compile_result, self.work_dir)
         except Exception as e:
             print(e)
             result = False
-            compile_error_info = str(e)
+            # Marked as an error of the environment, so that it is not cached as the verdict of the compiler
+            compile_error_info = f"{utils.EXCEPTION_PREFIX}{e}"
             return result, compile_error_info
 
     def compile_project(self):
@@ -68,16 +106,114 @@ class Defects4j(Benchmark):
             return False, str(e)
 
     def test_failed_test_cases(self, failed_test_cases: list):
+        if utils.TEST_BACKEND == "junit":
+            test_classes = {}
+            for test_case in failed_test_cases:
+                test_class, test_method = split_test_case(test_case)
+                if test_method is None:
+                    # A class-level failure runs the whole class (None), which covers its selected methods as well
+                    test_classes[test_class] = None
+                elif test_classes.get(test_class, []) is not None:
+                    test_classes.setdefault(test_class, []).append(test_method)
+            try:
+                failing_tests, _ = self.run_junit_tests(test_classes, TEST_TIMEOUT * len(failed_test_cases))
+                return {test_case: get_failing_test(self.work_dir, self.test_source_dir, test_case, failing_info)
+                        for test_case, failing_info in failing_tests.items()}
+            except TimeoutError:
+                return {test_case: get_failing_test(self.work_dir, self.test_source_dir, test_case, utils.TIMEOUT_ERROR)
+                        for test_case in failed_test_cases}
+            except Exception as e:
+                print(f"The JUnit runner failed, falling back to defects4j test: {e}")
         test_result = run_test_cases(self.database_name, self.work_dir, self.test_source_dir, failed_test_cases)
         return test_result
 
     def test_project(self):
+        if utils.TEST_BACKEND == "junit" or utils.TEST_SHARDS > 1:
+            try:
+                return self.test_project_sharded()
+            except TimeoutError as e:
+                raise Exception(f"Time out: {e}")
+            except Exception as e:
+                print(f"The sharded test run failed, falling back to defects4j test: {e}")
         failing_test_num, test_result = test_project(self.database_name, self.bug_id, self.work_dir,
                                                      self.test_source_dir)
         return failing_test_num, test_result
 
-    def recover_files(self, file_list):
-        self.compile_files(file_list)
+    def test_project_sharded(self):
+        """
+            Runs the test classes in utils.TEST_SHARDS JUnit JVMs concurrently, the classes are balanced over the
+            shards by their durations in earlier runs of the same project.
+        """
+        if utils.TEST_BACKEND != "junit":
+            # javac wrote the patched classes next to the sources, the build directory is updated by defects4j
+            compile_project(self.database_name, self.bug_id, self.work_dir)
+        project = self.bug_id.split("-")[0]
+        durations = utils.get_artifact_store().get(self.database_name, project, TEST_DURATIONS_ARTIFACT, default={})
+        test_classes = get_all_test_classes(self.database_name, self.work_dir, self.bug_id)
+        if len(test_classes) == 0:
+            # An empty shard would report a passing test suite
+            raise Exception(f"No test classes of {self.bug_id} to shard")
+        shards = split_into_shards(test_classes, durations, utils.TEST_SHARDS)
+        get_junit_service(self.work_dir, JAVA_8_HOME, utils.TEST_SHARDS)
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            shard_results = list(executor.map(
+                lambda shard: self.run_junit_tests({test_class: None for test_class in shard}, SHARD_TIMEOUT), shards))
+        failing_tests = {}
+        for shard_failing_tests, shard_durations in shard_results:
+            failing_tests.update(shard_failing_tests)
+            durations.update(shard_durations)
+        utils.get_artifact_store().put(self.database_name, project, TEST_DURATIONS_ARTIFACT, durations)
+        if len(failing_tests) == 0:
+            return 0, {}
+        # Tests that only fail under JUnit are excluded by defects4j test (broken tests), they do not count towards
+        # discarding the candidate
+        junit_only_failures = set(utils.get_artifact_store().get(self.database_name, self.bug_id,
+                                                                 JUNIT_ONLY_FAILURES_ARTIFACT, default=[]))
+        if len([test_name for test_name in failing_tests if test_name not in junit_only_failures]) >= \
+                utils.FAILING_TEST_THRESHOLD:
+            # The candidate is only discarded once defects4j test confirms the failures
+            failing_test_num, test_result = test_project(self.database_name, self.bug_id, self.work_dir,
+                                                         self.test_source_dir)
+            if failing_test_num < utils.FAILING_TEST_THRESHOLD:
+                utils.get_artifact_store().put(self.database_name, self.bug_id, JUNIT_ONLY_FAILURES_ARTIFACT,
+                                               sorted(junit_only_failures | (set(failing_tests) - set(test_result))))
+            return failing_test_num, test_result
+        # defects4j test excludes the broken tests of a project, so failing methods are confirmed by defects4j test
+        class_failures = {test_name: {"test_method": test_name, "test_case_code": "", "failing_info": failing_info}
+                          for test_name, failing_info in failing_tests.items()
+                          if test_name.endswith("::initializationError") and test_name not in junit_only_failures}
+        test_result = run_test_cases(self.database_name, self.work_dir, self.test_source_dir,
+                                     [test_name for test_name in failing_tests
+                                      if not test_name.endswith("::initializationError")])
+        test_result.update(class_failures)
+        return len(test_result), test_result
+
+    def test_related_tests(self):
+        # defects4j test -r runs the relevant tests, i.e., the test classes that load a class modified by the fix.
+        # Like the whole test suite, the run is only stopped at utils.FAILING_TEST_THRESHOLD failing tests, so that
+        # their number still decides whether the candidate is discarded
+        return test_project(self.database_name, self.bug_id, self.work_dir, self.test_source_dir, relevant=True)
+
+    def run_junit_tests(self, test_classes, timeout=None):
+        return run_junit_tests(self.work_dir, JAVA_8_HOME, self.test_class_path, JUNIT_JAR, test_classes, timeout,
+                               utils.TEST_SHARDS)
+
+    def start_services(self):
+        get_compiler_service(JAVA_8_HOME)
+
+    def release_runners(self):
+        stop_junit_services(self.work_dir)
+
+    def get_class_dirs(self, file):
+        # Without the JUnit runner, javac writes the classes next to the sources, defects4j test into build_dir
+        class_dirs = super().get_class_dirs(file)
+        if utils.TEST_BACKEND != "junit":
+            class_dirs.append(os.path.dirname(os.path.join(self.work_dir, file)))
+        return class_dirs
+
+    def rebase_clone(self, clone_benchmark):
+        clone_benchmark.compile_jar_path = self.compile_jar_path.replace(self.work_dir, clone_benchmark.work_dir)
+        clone_benchmark.test_class_path = self.test_class_path.replace(self.work_dir, clone_benchmark.work_dir)
 
     def get_all_bugs(self):
         d4j_v1_2 = {
@@ -252,103 +388,132 @@ def init_defects4j_trans_env(bug_id, working_dir):
 
 
 def get_test_code(working_dir, test_source_dir, test_name):
-    test_class = test_name.split("::")[0]
-    test_method = test_name.split("::")[1]
+    test_class, test_method = split_test_case(test_name)
+    if test_method is None:
+        return ""
     return utils.get_test_code(working_dir, test_source_dir, test_class, test_method)
 
 
-def run_single_test(database_name, working_dir, test_source_dir, test_case):
-    prepare_dataset_env_cmd = ""
-    if database_name == "defects4jv1.2" or database_name == "Defects4jv1.2":
-        prepare_dataset_env_cmd = Defects4J_CMD
-    elif database_name == "defects4jv2" or database_name == "defects4j-trans":
-        prepare_dataset_env_cmd = Defects4J_V2_CMD
-    test_cmd = f"defects4j test -w {working_dir} -t {test_case}"
-    execute_cmd = " && ".join([prepare_dataset_env_cmd, test_cmd])
-    error_file = open("stderr.txt", "wb")
-    test_result = subprocess.Popen(execute_cmd, shell=True, stdout=subprocess.PIPE, stderr=error_file, bufsize=-1,
-                                   start_new_session=True)
-    while_begin = time.time()
-    error_string = ""
-    Returncode = ""
-    timed_out = False
-    failing_tests = []
-    while True:
-        Flag = test_result.poll()
-        if Flag == 0:
-            Returncode = test_result.stdout.readlines()  # child.stdout.read()
-            # print(b"".join(Returncode).decode('utf-8'))
-            # error_file.close()
-            break
-        elif Flag != 0 and Flag is not None:
-            compile_fail = True
-            error_file.close()
-            with open("stderr.txt", "rb") as f:
-                r = f.readlines()
-            for line in r:
-                if re.search(':\serror:\s', line.decode('utf-8')):
-                    error_string = line.decode('utf-8')
+def get_failing_test(working_dir, test_source_dir, test_case, failing_info):
+    failing_test = {"test_method": test_case}
+    failing_test["test_case_code"] = get_test_code(working_dir, test_source_dir, test_case)
+    failing_test["failing_info"] = failing_info
+    return failing_test
+
+
+def run_test_batch(database_name, working_dir, test_source_dir, test_class, test_methods):
+    """
+        Runs several test methods of a test class in one `defects4j test` invocation (ant runs the comma separated
+        methods of -t), and reads the outcome of each test from the failing_tests file. A batch that times out is
+        run again one test at a time, so that only the tests that time out on their own are reported as such.
+    """
+    test_cases = [f"{test_class}::{test_method}" for test_method in test_methods]
+    failing_tests_file = os.path.join(working_dir, "failing_tests")
+    if os.path.exists(failing_tests_file):
+        os.remove(failing_tests_file)
+    test_cmd = f"defects4j test -w {working_dir} -t {test_class}::{','.join(test_methods)}"
+    execute_cmd = " && ".join([get_dataset_env_cmd(database_name), test_cmd])
+    # Each invocation captures its output in its own temporary files, so concurrent runs never share them
+    with tempfile.TemporaryFile() as out_file, tempfile.TemporaryFile() as error_file:
+        test_process = subprocess.Popen(execute_cmd, shell=True, stdout=out_file, stderr=error_file,
+                                        start_new_session=True)
+        try:
+            returncode = test_process.wait(timeout=TEST_TIMEOUT * len(test_methods))
+        except subprocess.TimeoutExpired:
+            kill_process_group(test_process)
+            if len(test_methods) > 1:
+                # The tests of a batch share its time budget, each test is run alone to find the ones that time out
+                test_results = {}
+                for test_method in test_methods:
+                    test_results.update(run_test_batch(database_name, working_dir, test_source_dir, test_class,
+                                                       [test_method]))
+                return test_results
+            return {test_case: get_failing_test(working_dir, test_source_dir, test_case, utils.TIMEOUT_ERROR)
+                    for test_case in test_cases}
+        if returncode != 0:
+            error_file.seek(0)
+            error_string = ""
+            for line in error_file.read().decode('utf-8', errors='replace').split("\n"):
+                if re.search(r':\serror:\s', line):
+                    error_string = line
                     break
-            failing_test = {"test_method": test_case}
-            failing_test["test_case_code"] = get_test_code(working_dir, test_source_dir,
-                                                           failing_test.get("test_method"))
-            failing_test["failing_info"] = error_string
-            return {test_case: failing_test}
-        elif time.time() - while_begin > 15:
-            error_file.close()
-            # print('time out error')
-            os.killpg(os.getpgid(test_result.pid), signal.SIGTERM)
-            timed_out = True
-            failing_test = {"test_method": test_case}
-            failing_test["test_case_code"] = get_test_code(working_dir, test_source_dir,
-                                                           failing_test.get("test_method"))
-            failing_test["failing_info"] = "Time out error"
-            return {test_case: failing_test}
-        else:
-            time.sleep(1)
-    log = Returncode
-    if len(log) > 0 and log[-1].decode('utf-8') == "Failing tests: 0\n":
-        return {}
-    else:
-        return get_test_info(database_name, working_dir, test_source_dir)
+            if error_string == "":
+                error_string = f"{utils.EXCEPTION_PREFIX}defects4j test exited with code {returncode}"
+            return {test_case: get_failing_test(working_dir, test_source_dir, test_case, error_string)
+                    for test_case in test_cases}
+    test_results = {}
+    for test_name, failing_test in parse_failing_tests(working_dir, test_source_dir).items():
+        if test_name in test_cases:
+            test_results[test_name] = failing_test
+        elif test_name.split("::")[0] == test_class:
+            # A failure of the whole class (e.g., in its static initializer) fails all of its tests
+            for test_case in test_cases:
+                if test_case not in test_results:
+                    test_results[test_case] = get_failing_test(working_dir, test_source_dir, test_case,
+                                                               failing_test.get("failing_info"))
+    return test_results
+
+
+def kill_process_group(process):
+    os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+        process.wait()
+
+
+def split_test_case(test_case):
+    # "Class::method", or the class and None for a class-level name (e.g., a failure of a static initializer)
+    test_class, _, test_method = test_case.partition("::")
+    return test_class, test_method if test_method != "" else None
 
 
 def run_test_cases(database_name, working_dir, test_source_dir, test_cases):
-    test_results = {}
+    test_methods_map = {}
     for test_case in test_cases:
+        test_class, test_method = split_test_case(test_case)
+        if test_method is None:
+            # defects4j test -t only selects test methods, the class is left to the run of the whole test suite
+            print(f"Skipping the class-level test {test_case}, defects4j test cannot run a single test class.")
+            continue
+        test_methods_map.setdefault(test_class, []).append(test_method)
+    test_results = {}
+    for test_class, test_methods in test_methods_map.items():
         try:
-            test_result = run_single_test(database_name, working_dir, test_source_dir, test_case)
-            test_results.update(test_result)
+            test_results.update(run_test_batch(database_name, working_dir, test_source_dir, test_class,
+                                               test_methods))
         except Exception as e:
-            test_result = {}
-            failing_test = {"test_method": test_case}
-            failing_test["test_case_code"] = get_test_code(working_dir, test_source_dir,
-                                                           failing_test.get("test_method"))
-            failing_test["failing_info"] = f"Exception: {e}"
-            test_result[test_case] = failing_test
-            test_results.update(test_result)
-
+            for test_method in test_methods:
+                test_case = f"{test_class}::{test_method}"
+                test_results[test_case] = get_failing_test(working_dir, test_source_dir, test_case,
+                                                           f"{utils.EXCEPTION_PREFIX}{e}")
     return test_results
 
 
-def test_project(database_name, bug_id, working_dir, test_source_dir):
+def test_project(database_name, bug_id, working_dir, test_source_dir, relevant=False):
     prepare_dataset_env_cmd = ""
     if database_name == "defects4jv1.2" or database_name == "Defects4jv1.2":
         prepare_dataset_env_cmd = Defects4J_CMD
     elif database_name == "defects4jv2" or database_name == "defects4j-trans":
         prepare_dataset_env_cmd = Defects4J_V2_CMD
     cd_working_dir_cmd = f"cd {working_dir}"
-    test_cmd = f"defects4j test"
+    test_cmd = f"defects4j test -r" if relevant else f"defects4j test"
     execute_cmd = " && ".join([prepare_dataset_env_cmd, cd_working_dir_cmd, test_cmd])
     if not os.path.exists("output"):
         os.makedirs("output")
     logger = Logger(os.path.join("output", bug_id + "_result.txt"))
     try:
-        run_command(execute_cmd, logger)
-        with open(os.path.join("output", bug_id + "_result.txt"), 'r', encoding='utf-8') as file:
-            first_line = file.readline().strip()
-            failing_tests = int(first_line.split(": ")[1])
-        if failing_tests < 30:
+        output, stopped_failing_tests = run_test_command(execute_cmd, working_dir, logger,
+                                                         utils.FAILING_TEST_THRESHOLD)
+        if stopped_failing_tests is not None:
+            return stopped_failing_tests, {}
+        failing_tests = 0
+        for line in output.split("\n"):
+            if line.startswith("Failing tests: "):
+                failing_tests = int(line.split(": ")[1])
+                break
+        if failing_tests < utils.FAILING_TEST_THRESHOLD:
             return failing_tests, get_test_info(database_name, working_dir, test_source_dir, failing_tests)
         else:
             # return failing_tests, get_test_info(database_name, working_dir, test_source_dir, 30)
@@ -358,6 +523,56 @@ def test_project(database_name, bug_id, working_dir, test_source_dir):
     # return 1, e
 
 
+def run_test_command(execute_cmd, working_dir, logger, threshold, timeout=300):
+    """
+        Runs a defects4j test command while watching the failing_tests file it writes. Once threshold tests have
+        failed, the process group is killed. Returns the output and, for a stopped run, the failing tests seen so far.
+    """
+    start_time = time.time()
+    failing_tests_file = os.path.join(working_dir, "failing_tests")
+    if os.path.exists(failing_tests_file):
+        os.remove(failing_tests_file)
+    with tempfile.TemporaryFile() as out_file, tempfile.TemporaryFile() as error_file:
+        test_process = subprocess.Popen(execute_cmd, shell=True, stdout=out_file, stderr=error_file,
+                                        start_new_session=True)
+        failing_tests, offset = 0, 0
+        while test_process.poll() is None:
+            if time.time() - start_time > timeout:
+                kill_process_group(test_process)
+                logger.log(f"Time out: {execute_cmd}")
+                raise Exception(f"Time out: {execute_cmd} timed out after {timeout} seconds")
+            failing_tests, offset = count_failing_tests(failing_tests_file, failing_tests, offset)
+            if failing_tests >= threshold:
+                kill_process_group(test_process)
+                logger.log(f"Stopped the tests after {failing_tests} failing tests")
+                return "", failing_tests
+            time.sleep(0.5)
+        out_file.seek(0)
+        output = out_file.read().decode('utf-8', errors='replace')
+        logger.log(output)
+        if test_process.returncode != 0:
+            error_file.seek(0)
+            error_output = error_file.read().decode('utf-8', errors='replace')
+            logger.log(error_output)
+            raise Exception(error_output)
+    logger.log(f"cmd execution time: {time.time() - start_time}")
+    return output, None
+
+
+def count_failing_tests(failing_tests_file, failing_tests, offset):
+    # Counts the "--- Class::method" lines appended since offset, a partially written line is read next time
+    if not os.path.exists(failing_tests_file):
+        return failing_tests, offset
+    with open(failing_tests_file, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n")
+    if end == -1:
+        return failing_tests, offset
+    failing_tests += sum(1 for line in data[:end].split(b"\n") if line.startswith(b"--- "))
+    return failing_tests, offset + end + 1
+
+
 def compile_project(database_name, bug_id, working_dir):
     prepare_dataset_env_cmd = ""
     if database_name == "defects4jv1.2" or database_name == "Defects4jv1.2":
@@ -374,18 +589,17 @@ def compile_project(database_name, bug_id, working_dir):
 
 
 def get_test_info(database_name, working_dir, test_source_dir, num_tests=1):
-    prepare_dataset_env_cmd = ""
-    if database_name == "defects4jv1.2" or database_name == "Defects4jv1.2":
-        prepare_dataset_env_cmd = Defects4J_CMD
-    elif database_name == "defects4jv2" or database_name == "defects4j-trans":
-        prepare_dataset_env_cmd = Defects4J_V2_CMD
-    cd_working_dir_cmd = f"cd {working_dir}"
-    cat_test_info = "cat failing_tests"
-    execute_cmd = " && ".join([prepare_dataset_env_cmd, cd_working_dir_cmd, cat_test_info])
-    test_result = subprocess.Popen(execute_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=-1,
-                                   start_new_session=True)
+    return parse_failing_tests(working_dir, test_source_dir, num_tests)
+
+
+def parse_failing_tests(working_dir, test_source_dir, num_tests=None):
+    # Each failing test is a "--- Class::method" line, followed by its failing info and the stack trace
+    failing_tests_file = os.path.join(working_dir, "failing_tests")
+    if not os.path.exists(failing_tests_file):
+        return {}
+    with open(failing_tests_file, 'r', encoding='utf-8', errors='replace') as f:
+        test_info = f.read()
     failing_tests = {}
-    test_info = test_result.stdout.read().decode("utf-8")
     flag = False
     failing_test = {}
     i = 0
@@ -394,37 +608,88 @@ def get_test_info(database_name, working_dir, test_source_dir, num_tests=1):
             flag = True
             failing_test["test_method"] = line.split(" ")[1]
             failing_test["test_case_code"] = get_test_code(working_dir, test_source_dir,
-                                                           failing_test.get("test_method"))
+                                                           failing_test.get("test_method")) \
+                if "::" in failing_test.get("test_method") else ""
         elif flag:
             flag = False
             failing_test["failing_info"] = line
             failing_tests[failing_test.get("test_method")] = failing_test
             failing_test = {}
             i += 1
-            if i >= num_tests:
+            if num_tests is not None and i >= num_tests:
                 break
     return failing_tests
 
 
-def get_necessary_path(database_name, working_dir):
-    prepare_dataset_env_cmd = ""
+def get_dataset_env_cmd(database_name):
     if database_name == "defects4jv1.2" or database_name == "Defects4jv1.2":
-        prepare_dataset_env_cmd = Defects4J_CMD
+        return Defects4J_CMD
     elif database_name == "defects4jv2" or database_name == "defects4j-trans":
-        prepare_dataset_env_cmd = Defects4J_V2_CMD
-    source_dir = os.popen(
-        " && ".join([prepare_dataset_env_cmd, "defects4j export -p dir.src.classes -w " + working_dir])).readlines()[
-        -1].strip()
-    class_path_cmd = " && ".join([prepare_dataset_env_cmd, "defects4j export -p cp.compile -w " +
-                                  working_dir])
-    compile_jar_path = os.popen(class_path_cmd).readlines()[-1].strip()
-    classes_build_dir = \
-        os.popen(
-            prepare_dataset_env_cmd + " && " + "defects4j export -p dir.bin.classes -w " + working_dir).readlines()[
-            -1].strip()
-    test_build_dir = os.popen(
-        prepare_dataset_env_cmd + " && " + "defects4j export -p cp.test -w " + working_dir).readlines()[
-        -1].strip()
+        return Defects4J_V2_CMD
+    return ""
+
+
+def export_properties(database_name, working_dir, properties):
+    # All the exports run in one shell, the output of each one is preceded by a marker line
+    export_cmds = [get_dataset_env_cmd(database_name)]
+    for export_property in properties:
+        export_cmds.append(f"echo && echo '{EXPORT_MARKER}{export_property}'")
+        export_cmds.append(f"defects4j export -p {export_property} -w {working_dir}")
+    execute_cmd = " && ".join(cmd for cmd in export_cmds if cmd != "")
+    result = subprocess.run(execute_cmd, shell=True, capture_output=True, text=True, timeout=600)
+    exports = {}
+    export_property = None
+    for line in result.stdout.split("\n"):
+        if line.startswith(EXPORT_MARKER):
+            export_property = line[len(EXPORT_MARKER):].strip()
+        elif export_property is not None and line.strip() != "":
+            if export_property in MULTI_LINE_EXPORTS and export_property in exports:
+                exports[export_property] += "\n" + line.strip()
+            else:
+                exports[export_property] = line.strip()
+    for export_property in properties:
+        if export_property not in exports:
+            raise Exception(f"Failed to export {export_property} of {working_dir}: {result.stderr}")
+    return exports
+
+
+def get_exports(database_name, working_dir, bug_id=None):
+    """
+        Returns the exported properties of a checked out bug. They are stored with the working directory replaced by
+        a placeholder, so that checkouts of the same bug in other working directories reuse them.
+    """
+    if bug_id is not None:
+        exports = utils.get_artifact_store().get(database_name, bug_id, EXPORTS_ARTIFACT)
+        if exports is not None:
+            return {key: value.replace(WORK_DIR_PLACEHOLDER, working_dir) for key, value in exports.items()}
+    exports = export_properties(database_name, working_dir, EXPORT_PROPERTIES)
+    if bug_id is not None:
+        utils.get_artifact_store().put(database_name, bug_id, EXPORTS_ARTIFACT,
+                                       {key: value.replace(working_dir, WORK_DIR_PLACEHOLDER)
+                                        for key, value in exports.items()})
+    return exports
+
+
+def get_all_test_classes(database_name, working_dir, bug_id):
+    # An empty list (e.g., of a failed export) is not cached, the caller falls back to defects4j test
+    all_tests = [test_class for test_class in
+                 utils.get_artifact_store().get(database_name, bug_id, ALL_TESTS_ARTIFACT, default=[])
+                 if test_class.strip() != ""]
+    if len(all_tests) == 0:
+        all_tests = [test_class.strip() for test_class in
+                     export_properties(database_name, working_dir, ["tests.all"])["tests.all"].split("\n")
+                     if test_class.strip() != ""]
+        if len(all_tests) > 0:
+            utils.get_artifact_store().put(database_name, bug_id, ALL_TESTS_ARTIFACT, all_tests)
+    return all_tests
+
+
+def get_necessary_path(database_name, working_dir, bug_id=None):
+    exports = get_exports(database_name, working_dir, bug_id)
+    source_dir = exports["dir.src.classes"]
+    compile_jar_path = exports["cp.compile"]
+    classes_build_dir = exports["dir.bin.classes"]
+    test_build_dir = exports["cp.test"]
     for path in test_build_dir.split(os.pathsep):
         if path.endswith("test") or path.endswith("tests") or path.endswith("test-classes"):
             if path.find("src") != -1:
@@ -434,37 +699,40 @@ def get_necessary_path(database_name, working_dir):
             else:
                 test_build_dir = path
             break
-    test_source_dir = os.popen(" && ".join([prepare_dataset_env_cmd, "defects4j export -p dir.src.tests -w " +
-                                            working_dir])).readlines()[-1].strip()
+    test_source_dir = exports["dir.src.tests"]
     return compile_jar_path, source_dir, classes_build_dir, test_source_dir, test_build_dir
 
 
-def javac_compile(database_name, working_dir, classes_path, target_file_path):
-    compiled_result = {}
-    prepare_dataset_env_cmd = ""
+def get_compile_options(database_name, working_dir, output_dir=None):
+    options = []
     if database_name == "defects4jv1.2" or database_name == "Defects4jv1.2":
-        prepare_dataset_env_cmd = Defects4J_CMD
-    elif database_name == "defects4jv2" or database_name == "defects4j-trans":
-        prepare_dataset_env_cmd = Defects4J_V2_CMD
+        # The compiler service runs on Java 8, the projects of Defects4J v1.2 are built with Java 7
+        options += ["-source", "1.7", "-target", "1.7"]
+        if os.path.exists(JAVA_7_BOOT_CLASSPATH):
+            options += ["-bootclasspath", JAVA_7_BOOT_CLASSPATH]
+    if output_dir is not None:
+        options += ["-d", os.path.join(working_dir, output_dir)]
+    return options
+
+
+def javac_compile(database_name, working_dir, classes_path, source_files, options):
+    # All the files are compiled by one javac process, its output is parsed into the diagnostics of the service
     cd_working_dir_cmd = f"cd {working_dir}"
-    javac_compile_cmd = f"javac -cp {classes_path} {os.path.join(working_dir, target_file_path)}"
-    exec_cmd = " && ".join([prepare_dataset_env_cmd, cd_working_dir_cmd, javac_compile_cmd])
-    result = subprocess.run(exec_cmd, shell=True, capture_output=True, text=True)
-    compiled_info = result.stdout
-    if result.returncode != 0:
-        compiled_result["compiled_file"] = target_file_path
-        compiled_result["compiled_result"] = False
-        compiled_result["compiled_info"] = result.stderr
-    else:
-        compiled_result["compiled_file"] = target_file_path
-        compiled_result["compiled_result"] = True
-        compiled_result["compiled_info"] = compiled_info
-    return compiled_result
-
-
-def compile_files(database_name, working_dir, class_path, file_list: list):
-    compile_results = []
-    for file_path in file_list:
-        compile_result = javac_compile(database_name, working_dir, class_path, file_path)
-        compile_results.append(compile_result)
-    return compile_results
+    javac_compile_cmd = f"javac -cp {classes_path} {' '.join(options)} {' '.join(source_files)}"
+    exec_cmd = " && ".join([get_dataset_env_cmd(database_name), cd_working_dir_cmd, javac_compile_cmd])
+    result = subprocess.run(exec_cmd, shell=True, capture_output=True, text=True, timeout=COMPILE_TIMEOUT)
+    return {"success": result.returncode == 0, "diagnostics": parse_javac_output(result.stderr),
+            "output": result.stderr}
+
+
+def compile_files(database_name, working_dir, class_path, file_list: list, output_dir=None):
+    source_files = [os.path.join(working_dir, file_path) for file_path in file_list]
+    options = get_compile_options(database_name, working_dir, output_dir)
+    try:
+        return compile_sources(JAVA_8_HOME, class_path, source_files, options)
+    except TimeoutError:
+        raise
+    except Exception as e:
+        # Only this compilation falls back, the next one uses the restarted compiler service again
+        print(f"The compiler service is not available, falling back to javac: {e}")
+    return javac_compile(database_name, working_dir, class_path, source_files, options)
@@ -15,7 +15,8 @@ class GitBugJava(Benchmark):
 
     def checkout(self, bug_id):
         self.bug_id = bug_id
-        self.work_dir = os.path.join("/tmp", "gitbug-java", bug_id)
+        self.class_snapshots = {}
+        self.work_dir = os.path.join("/tmp", "gitbug-java", utils.WORKER_TEMP_DIR, bug_id)
 
         if os.path.exists(self.work_dir):
             shutil.rmtree(self.work_dir)
@@ -30,6 +31,7 @@ class GitBugJava(Benchmark):
         self.init_failing_tests = get_init_test_info(self.work_dir, self.test_source_dir)
 
     def compile_files(self, files: list):
+        self.snapshot_classes(files)
         try:
             run_work_flow(self.work_dir)
             return get_compile_errors(self.work_dir)
@@ -62,9 +64,6 @@ class GitBugJava(Benchmark):
                 test_info[test_name] = self.init_failing_tests[test_name]
         return test_info
 
-    def recover_files(self, file_list):
-        self.compile_files(file_list)
-
     def test_project(self):
         # test_info = {}
         # key is test_method in the format of "ClassName::methodName"
@@ -126,13 +125,8 @@ def get_init_test_info(working_dir, test_source_dir):
                     if test_info.get(test_name) is None:
                         test_info[test_name] = {}
                         test_info[test_name]["test_method"] = test_name
-                        if test.get('classname').find("$") != -1:
-                            test_info[test_name]["test_case_code"] = utils.get_test_code(
-                                working_dir, test_source_dir, test.get('classname')[:test.get('classname').rfind("$")],
-                                name)
-                        else:
-                            test_info[test_name]["test_case_code"] = utils.get_test_code(
-                                working_dir, test_source_dir, test.get('classname'), name)
+                        test_info[test_name]["test_case_code"] = utils.get_test_code(
+                            working_dir, test_source_dir, test.get('classname'), name)
                     if test_info[test_name].get("failing_info") is None:
                         test_info[test_name]["failing_info"] = []
                     message = ""
@@ -253,13 +247,8 @@ def get_test_info(working_dir, test_source_dir):
         return len(test_info), test_info
     else:
         for test, value in test_info.items():
-            class_name = test.split("::")[0]
-            if class_name.find("$") != -1:
-                value["test_case_code"] = utils.get_test_code(
-                    working_dir, test_source_dir, class_name[:class_name.rfind("$")], test.split("::")[1])
-            else:
-                value["test_case_code"] = utils.get_test_code(
-                    working_dir, test_source_dir, class_name, test.split("::")[1])
+            value["test_case_code"] = utils.get_test_code(
+                working_dir, test_source_dir, test.split("::")[0], test.split("::")[1])
 
         return len(test_info), test_info
 
@@ -0,0 +1,127 @@
+import atexit
+import os
+import re
+from collections import OrderedDict
+
+import jpype
+
+from jvm_service import JVMService
+
+# Compilers and file managers kept by a compiler process, keyed by class path, so that the jars are opened once
+file_managers = OrderedDict()
+MAX_FILE_MANAGERS = 4
+compiler_services = {}
+JAVAC_DIAGNOSTIC_PATTERN = re.compile(r"^(.+\.java):(\d+): (error|warning): (.*)$")
+JAVAC_DETAIL_PREFIXES = ("symbol:", "location:", "required:", "found:", "reason:")
+MAX_COMPILE_ERRORS = 5
+COMPILE_TIMEOUT = 300
+
+
+def to_java_list(values):
+    java_list = jpype.JClass("java.util.ArrayList")()
+    for value in values:
+        java_list.add(value)
+    return java_list
+
+
+def get_file_manager(class_path):
+    if class_path in file_managers:
+        file_managers.move_to_end(class_path)
+    else:
+        compiler = jpype.JClass("javax.tools.ToolProvider").getSystemJavaCompiler()
+        if compiler is None:
+            raise RuntimeError("The JVM of the compiler service is not a JDK.")
+        file_manager = compiler.getStandardFileManager(None, None, None)
+        File = jpype.JClass("java.io.File")
+        file_manager.setLocation(jpype.JClass("javax.tools.StandardLocation").CLASS_PATH,
+                                 to_java_list([File(path) for path in class_path.split(os.pathsep) if path != ""]))
+        file_managers[class_path] = (compiler, file_manager)
+        if len(file_managers) > MAX_FILE_MANAGERS:
+            _, (_, evicted_file_manager) = file_managers.popitem(last=False)
+            evicted_file_manager.close()
+    return file_managers[class_path]
+
+
+def compile_sources_working(class_path, source_files, options):
+    """
+        Runs in a compiler process. Compiles all the source files in one javax.tools task, returns whether it
+        succeeded and the diagnostics of the compiler.
+    """
+    compiler, file_manager = get_file_manager(class_path)
+    collector = jpype.JClass("javax.tools.DiagnosticCollector")()
+    compilation_units = file_manager.getJavaFileObjectsFromStrings(to_java_list(source_files))
+    success = bool(compiler.getTask(None, file_manager, collector, to_java_list(options), None,
+                                    compilation_units).call())
+    locale = jpype.JClass("java.util.Locale").ENGLISH
+    diagnostics = []
+    for diagnostic in collector.getDiagnostics():
+        source = diagnostic.getSource()
+        diagnostics.append({"file": str(source.getName()) if source is not None else "",
+                            "line": int(diagnostic.getLineNumber()),
+                            "column": int(diagnostic.getColumnNumber()),
+                            "kind": str(diagnostic.getKind().name()).lower(),
+                            "message": str(diagnostic.getMessage(locale))})
+    return {"success": success, "diagnostics": diagnostics, "output": ""}
+
+
+def get_compiler_service(java_home):
+    if compiler_services.get(java_home) is None:
+        compiler_services[java_home] = JVMService(1, "", java_home, timeout=COMPILE_TIMEOUT)
+        atexit.register(compiler_services[java_home].stop)
+    return compiler_services.get(java_home)
+
+
+def compile_sources(java_home, class_path, source_files, options):
+    compiler_service = get_compiler_service(java_home)
+    try:
+        return compiler_service.call(compile_sources_working, class_path, source_files, options)
+    except TimeoutError:
+        # The hanging worker has already been restarted
+        raise
+    except Exception as e:
+        print(f"The compiler service failed, restarting it: {e}")
+        compiler_service.restart()
+        return compiler_service.call(compile_sources_working, class_path, source_files, options)
+
+
+def parse_javac_output(output):
+    # The same diagnostics as the compiler service, parsed from the output of a javac process
+    diagnostics = []
+    for line in output.split("\n"):
+        match = JAVAC_DIAGNOSTIC_PATTERN.match(line)
+        if match is not None:
+            diagnostics.append({"file": match.group(1), "line": int(match.group(2)), "column": -1,
+                                "kind": match.group(3), "message": match.group(4)})
+        elif len(diagnostics) > 0 and line.strip().startswith(JAVAC_DETAIL_PREFIXES):
+            # Details of the message, e.g., the symbol and location of "cannot find symbol"
+            diagnostics[-1]["message"] += "\n" + line.strip()
+    return diagnostics
+
+
+def read_source_line(file_path, line_number):
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            for i, line in enumerate(f, 1):
+                if i == line_number:
+                    return line.strip()
+    except OSError:
+        pass
+    return ""
+
+
+def format_compile_errors(compile_result, working_dir, max_errors=MAX_COMPILE_ERRORS):
+    """ Renders the first errors with their location and source line, instead of the raw output of javac. """
+    errors = [diagnostic for diagnostic in compile_result.get("diagnostics") if diagnostic.get("kind") == "error"]
+    if len(errors) == 0:
+        return compile_result.get("output")
+    lines = []
+    for error in errors[:max_errors]:
+        file_path = error.get("file")
+        relative_path = os.path.relpath(file_path, working_dir) if file_path.startswith(working_dir) else file_path
+        lines.append(f"{relative_path}:{error.get('line')}: error: {error.get('message')}")
+        source_line = read_source_line(file_path, error.get("line"))
+        if source_line != "":
+            lines.append(f"    {source_line}")
+    if len(errors) > max_errors:
+        lines.append(f"... {len(errors) - max_errors} more errors")
+    return "\n".join(lines)
@@ -0,0 +1,118 @@
+import atexit
+import heapq
+import os
+import time
+
+import jpype
+
+from jvm_service import JVMService
+
+# Loaders of the dependency jars kept by a runner process, the classes of the project are reloaded on every run
+library_loaders = {}
+junit_services = {}
+
+
+def to_urls(paths):
+    URL = jpype.JClass("java.net.URL")
+    File = jpype.JClass("java.io.File")
+    return jpype.JArray(URL)([File(path).toURI().toURL() for path in paths])
+
+
+def get_library_loader(jar_paths):
+    key = tuple(jar_paths)
+    if library_loaders.get(key) is None:
+        URLClassLoader = jpype.JClass("java.net.URLClassLoader")
+        ClassLoader = jpype.JClass("java.lang.ClassLoader")
+        # Parent is the extension loader, so that the class path of the runner itself is not visible to the tests
+        library_loaders[key] = URLClassLoader(to_urls(jar_paths), ClassLoader.getSystemClassLoader().getParent())
+    return library_loaders.get(key)
+
+
+def first_line(text):
+    lines = str(text).strip().split("\n")
+    return lines[0].strip() if len(lines) > 0 else ""
+
+
+def run_junit_tests_working(class_path, junit_jar, test_classes):
+    """
+        Runs in a runner process. test_classes maps a test class to the list of its methods to run, or to None to
+        run the whole class. Returns a dict of the failing tests ("Class::method") and their first trace line, and
+        the duration of each test class in seconds.
+    """
+    paths = [path for path in class_path.split(os.pathsep) if path != ""]
+    jar_paths = [path for path in paths if path.endswith(".jar")] + [junit_jar]
+    dir_paths = [path for path in paths if not path.endswith(".jar")]
+    URLClassLoader = jpype.JClass("java.net.URLClassLoader")
+    System = jpype.JClass("java.lang.System")
+    Thread = jpype.JClass("java.lang.Thread")
+    PrintStream = jpype.JClass("java.io.PrintStream")
+    ByteArrayOutputStream = jpype.JClass("java.io.ByteArrayOutputStream")
+    loader = URLClassLoader(to_urls(dir_paths), get_library_loader(jar_paths))
+    JUnitCore = jpype.JClass("org.junit.runner.JUnitCore", loader=loader)
+    Request = jpype.JClass("org.junit.runner.Request", loader=loader)
+    Class = jpype.JClass("java.lang.Class")
+    out, err = System.out, System.err
+    Thread.currentThread().setContextClassLoader(loader)
+    System.setOut(PrintStream(ByteArrayOutputStream()))
+    System.setErr(PrintStream(ByteArrayOutputStream()))
+    failing_tests = {}
+    durations = {}
+    try:
+        for test_class, test_methods in test_classes.items():
+            start_time = time.time()
+            try:
+                test_class_object = Class.forName(test_class, False, loader)
+            except Exception as e:
+                for test_method in (test_methods or ["initializationError"]):
+                    failing_tests[f"{test_class}::{test_method}"] = first_line(e)
+                continue
+            if test_methods is None:
+                requests = [Request.aClass(test_class_object)]
+            else:
+                requests = [Request.method(test_class_object, test_method) for test_method in test_methods]
+            for request in requests:
+                result = JUnitCore().run(request)
+                for failure in result.getFailures():
+                    description = failure.getDescription()
+                    test_name = f"{test_class}::{description.getMethodName() or 'initializationError'}"
+                    failing_tests[test_name] = first_line(failure.getTrace())
+            durations[test_class] = time.time() - start_time
+    finally:
+        System.setOut(out)
+        System.setErr(err)
+        loader.close()
+    return failing_tests, durations
+
+
+def get_junit_service(work_dir, java_home, size=1):
+    # Warm JVMs per working directory, started in the working directory since tests read files relative to it
+    if junit_services.get(work_dir) is None:
+        junit_services[work_dir] = JVMService(size, "", java_home, work_dir)
+    return junit_services.get(work_dir)
+
+
+def stop_junit_services(work_dir=None):
+    for service_dir in list(junit_services.keys()):
+        if work_dir is None or service_dir == work_dir or service_dir.startswith(f"{work_dir}-"):
+            junit_services.pop(service_dir).stop()
+
+
+def run_junit_tests(work_dir, java_home, class_path, junit_jar, test_classes, timeout=None, size=1):
+    return get_junit_service(work_dir, java_home, size).call(run_junit_tests_working, class_path, junit_jar,
+                                                             test_classes, timeout=timeout)
+
+
+def split_into_shards(test_classes, durations, shard_num):
+    # Longest processing time first: the slowest remaining class goes to the least loaded shard
+    known_durations = [durations.get(test_class) for test_class in test_classes if test_class in durations]
+    default_duration = sum(known_durations) / len(known_durations) if len(known_durations) > 0 else 1.0
+    shard_loads = [(0.0, i) for i in range(max(1, min(shard_num, len(test_classes))))]
+    shards = [[] for _ in shard_loads]
+    for test_class in sorted(test_classes, key=lambda name: durations.get(name, default_duration), reverse=True):
+        load, i = heapq.heappop(shard_loads)
+        shards[i].append(test_class)
+        heapq.heappush(shard_loads, (load + durations.get(test_class, default_duration), i))
+    return shards
+
+
+atexit.register(stop_junit_services)
@@ -21,7 +21,8 @@ class NewBenchmark(Benchmark):
     def checkout(self, bug_id):
         """Checkout the specific bug version from the repository"""
         self.bug_id = bug_id
-        self.work_dir = os.path.join("/tmp", bug_id)
+        self.class_snapshots = {}
+        self.work_dir = os.path.join("/tmp", utils.WORKER_TEMP_DIR, bug_id)
 
         # TODO: Implement repository checkout logic
         # - Clone or checkout the specific bug version
@@ -41,6 +42,8 @@ class NewBenchmark(Benchmark):
 
     def compile_files(self, files: list):
         """Compile specific files in the project"""
+        # Keep the classes of the original files, recover_files restores them instead of compiling again
+        self.snapshot_classes(files)
         # TODO: Implement incremental compilation
         # - Should only compile the specified files
         # - Return (success: bool, error_message: str)
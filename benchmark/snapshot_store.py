@@ -0,0 +1,104 @@
+import os
+import shutil
+import subprocess
+import time
+
+SNAPSHOT_MARKER = ".premm-snapshot"
+
+
+def copy_tree(source_dir, target_dir):
+    # Copy-on-write clone where the file system supports it (btrfs, xfs, ...), a plain copy otherwise.
+    # Hard links are not used, since patched sources and compiled classes are rewritten in place.
+    result = subprocess.run(["cp", "-a", "--reflink=auto", source_dir, target_dir], capture_output=True, text=True)
+    if result.returncode != 0:
+        if os.path.exists(target_dir):
+            shutil.rmtree(target_dir)
+        shutil.copytree(source_dir, target_dir, symlinks=True)
+
+
+def get_dir_size(dir_path):
+    size = 0
+    for root, _, files in os.walk(dir_path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+class SnapshotStore:
+    """
+        Pristine (checked out and compiled) working directories keyed by (dataset, bug_id).
+
+        New working directories are copied from a snapshot instead of being checked out and compiled again. When the
+        snapshots exceed max_bytes, the least recently used ones are removed.
+    """
+
+    def __init__(self, root_dir, max_bytes):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+
+    def get_snapshot_dir(self, dataset, bug_id):
+        return os.path.join(self.root_dir, dataset, bug_id)
+
+    def has(self, dataset, bug_id):
+        return os.path.exists(os.path.join(self.get_snapshot_dir(dataset, bug_id), SNAPSHOT_MARKER))
+
+    def materialize(self, dataset, bug_id, work_dir):
+        if not self.has(dataset, bug_id):
+            return False
+        snapshot_dir = self.get_snapshot_dir(dataset, bug_id)
+        try:
+            copy_tree(snapshot_dir, work_dir)
+            os.remove(os.path.join(work_dir, SNAPSHOT_MARKER))
+            # The modification time of the marker records the last use
+            os.utime(os.path.join(snapshot_dir, SNAPSHOT_MARKER))
+            return True
+        except OSError:
+            # The snapshot was evicted by another worker in the meantime
+            if os.path.exists(work_dir):
+                shutil.rmtree(work_dir)
+            return False
+
+    def save(self, dataset, bug_id, work_dir):
+        snapshot_dir = self.get_snapshot_dir(dataset, bug_id)
+        if self.has(dataset, bug_id):
+            return
+        if not os.path.exists(os.path.dirname(snapshot_dir)):
+            os.makedirs(os.path.dirname(snapshot_dir), exist_ok=True)
+        # Copy next to the final location and rename, so that a snapshot is never seen half written
+        temp_dir = f"{snapshot_dir}.{os.getpid()}.tmp"
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        copy_tree(work_dir, temp_dir)
+        with open(os.path.join(temp_dir, SNAPSHOT_MARKER), 'w') as f:
+            f.write(str(get_dir_size(temp_dir)))
+        try:
+            if os.path.exists(snapshot_dir):
+                shutil.rmtree(snapshot_dir)
+            os.rename(temp_dir, snapshot_dir)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        snapshots = []
+        for dataset in os.listdir(self.root_dir):
+            dataset_dir = os.path.join(self.root_dir, dataset)
+            if not os.path.isdir(dataset_dir):
+                continue
+            for bug_id in os.listdir(dataset_dir):
+                marker = os.path.join(dataset_dir, bug_id, SNAPSHOT_MARKER)
+                if os.path.exists(marker):
+                    with open(marker, 'r') as f:
+                        size = int(f.read().strip() or 0)
+                    snapshots.append((os.path.getmtime(marker), size, os.path.join(dataset_dir, bug_id)))
+        total_size = sum(snapshot[1] for snapshot in snapshots)
+        for _, size, snapshot_dir in sorted(snapshots):
+            if total_size <= self.max_bytes:
+                break
+            # Remove the marker first, so that nobody starts to copy a snapshot that is being removed
+            os.remove(os.path.join(snapshot_dir, SNAPSHOT_MARKER))
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            total_size -= size
+            print(f"Evict the snapshot {snapshot_dir} at {time.ctime()}")
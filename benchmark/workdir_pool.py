@@ -0,0 +1,61 @@
+import queue
+import threading
+
+import utils
+
+
+class WorkdirPool:
+    """
+        Clones of a compiled working directory that are leased to validators, so that several candidate patches can
+        be compiled and tested at the same time.
+
+        A released clone is reset by restoring only the files that were modified in it, i.e., the sources from the
+        temp directory of the clone and their classes from the class snapshots of the clone.
+    """
+
+    def __init__(self, benchmark, size=1):
+        self.benchmark = benchmark
+        self.size = 0
+        self.idle_clones = queue.Queue()
+        self.lock = threading.Lock()
+        self.clone_count = 0
+        self.grow(size)
+
+    def grow(self, size):
+        # The clones are materialized up front, so that leasing one never waits for a copy
+        while self.size < max(1, size):
+            self.idle_clones.put(self.create_clone())
+            self.size += 1
+
+    def create_clone(self):
+        with self.lock:
+            name = f"pool-{self.clone_count}"
+            self.clone_count += 1
+            return self.benchmark.clone(name)
+
+    def lease(self, timeout=None):
+        return self.idle_clones.get(timeout=timeout)
+
+    def release(self, clone_benchmark, modified_files):
+        try:
+            self.reset(clone_benchmark, modified_files)
+        except Exception as e:
+            # A clone that cannot be restored is replaced by a fresh copy of the working directory
+            print(f"Failed to reset {clone_benchmark.get_work_dir()}, replacing it: {e}")
+            self.remove_clone(clone_benchmark)
+            clone_benchmark = self.create_clone()
+        self.idle_clones.put(clone_benchmark)
+
+    def reset(self, clone_benchmark, modified_files):
+        if len(modified_files) == 0:
+            return
+        utils.recover_files(clone_benchmark.get_work_dir(), modified_files)
+        clone_benchmark.recover_files(modified_files)
+
+    def remove_clone(self, clone_benchmark):
+        with self.lock:
+            for name, other_benchmark in list(self.benchmark.clones.items()):
+                if other_benchmark is clone_benchmark:
+                    self.benchmark.clones.pop(name)
+        clone_benchmark.release_runners()
+        utils.remove_temp_dir(clone_benchmark.get_work_dir())
@@ -0,0 +1,203 @@
+import inspect
+import json
+import multiprocessing
+import os
+import queue
+import threading
+
+import jpype
+
+
+def serve(conn, class_path, java_home, cwd):
+    # Runs in the worker process: start the JVM once, then answer requests until the pipe is closed
+    if cwd is not None:
+        os.chdir(cwd)
+    if java_home is not None:
+        os.environ["JAVA_HOME"] = java_home
+    jpype.startJVM(jpype.getDefaultJVMPath(), "-ea", "-Djava.class.path=%s" % class_path)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        func, args = request
+        streaming = False
+        try:
+            result = func(*args)
+            if inspect.isgenerator(result):
+                # Generator requests are answered with one JSON message per record, so that large results are
+                # never rendered as a single string
+                streaming = True
+                for record in result:
+                    conn.send_bytes(json.dumps({"type": "record", "record": record}).encode("utf-8"))
+                conn.send_bytes(json.dumps({"type": "end"}).encode("utf-8"))
+            else:
+                conn.send(("ok", result))
+        except Exception as e:
+            if streaming:
+                conn.send_bytes(json.dumps({"type": "error", "message": f"{type(e).__name__}: {e}"}).encode("utf-8"))
+            else:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+    if jpype.isJVMStarted():
+        jpype.shutdownJVM()
+
+
+def ping():
+    return jpype.isJVMStarted()
+
+
+class JVMWorker:
+    def __init__(self, class_path, java_home=None, cwd=None):
+        self.class_path = class_path
+        self.java_home = java_home
+        self.cwd = cwd
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(child_conn, self.class_path, self.java_home,
+                                                                   self.cwd), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def call(self, func, args, timeout=None):
+        self.conn.send((func, args))
+        if not self.conn.poll(timeout):
+            # The request hangs, the JVM can only be recovered by killing its process
+            self.restart()
+            raise TimeoutError(f"JVM request {func.__name__} timed out after {timeout} s.")
+        status, result = self.conn.recv()
+        if status == "error":
+            raise RuntimeError(result)
+        return result
+
+    def stream(self, func, args, timeout=None):
+        self.conn.send((func, args))
+        finished = False
+        try:
+            while True:
+                if not self.conn.poll(timeout):
+                    raise TimeoutError(f"JVM request {func.__name__} timed out after {timeout} s.")
+                message = json.loads(self.conn.recv_bytes().decode("utf-8"))
+                if message.get("type") == "record":
+                    yield message.get("record")
+                else:
+                    finished = True
+                    if message.get("type") == "error":
+                        raise RuntimeError(message.get("message"))
+                    return
+        finally:
+            if not finished:
+                # Unread records are still in the pipe (or the request hangs), only a fresh process is usable
+                self.restart()
+
+
+class JVMService:
+    """
+        A pool of long-lived worker processes, each of which holds a started JVM.
+
+        Requests are module-level functions that are executed inside a worker process, so that they can use jpype
+        and keep per-process state (e.g., loaded analyzers) between requests. Dead or hanging workers are restarted.
+    """
+
+    def __init__(self, size=1, class_path="", java_home=None, cwd=None, timeout=None):
+        self.timeout = timeout
+        self.workers = [JVMWorker(class_path, java_home, cwd) for _ in range(max(1, size))]
+        self.idle_workers = queue.Queue()
+        self.lock = threading.Lock()
+        for worker in self.workers:
+            worker.start()
+            self.idle_workers.put(worker)
+
+    def call(self, func, *args, timeout=None):
+        worker = self.idle_workers.get()
+        try:
+            if not worker.is_alive():
+                worker.restart()
+            try:
+                return worker.call(func, args, timeout if timeout is not None else self.timeout)
+            except (EOFError, BrokenPipeError, ConnectionResetError):
+                # The worker died while handling the request (e.g., the JVM crashed), retry once on a fresh one
+                worker.restart()
+                return worker.call(func, args, timeout if timeout is not None else self.timeout)
+        finally:
+            self.idle_workers.put(worker)
+
+    def stream(self, func, *args, timeout=None):
+        """ Runs a generator request, yields its records as they are decoded. """
+        worker = self.idle_workers.get()
+        try:
+            if not worker.is_alive():
+                worker.restart()
+            yield from worker.stream(func, args, timeout if timeout is not None else self.timeout)
+        finally:
+            self.idle_workers.put(worker)
+
+    def check_health(self, timeout=30):
+        workers = self.acquire_all()
+        try:
+            for worker in workers:
+                try:
+                    if not worker.is_alive() or not worker.call(ping, (), timeout):
+                        worker.restart()
+                except Exception:
+                    worker.restart()
+        finally:
+            self.release_all(workers)
+
+    def broadcast(self, func, *args):
+        # Run a request on every worker, e.g., to drop the state kept for a removed working directory
+        workers = self.acquire_all()
+        try:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.call(func, args, self.timeout)
+        finally:
+            self.release_all(workers)
+
+    def restart(self):
+        # Fresh processes for all the workers, e.g., after a request left the state of a JVM broken
+        workers = self.acquire_all()
+        try:
+            for worker in workers:
+                worker.restart()
+        finally:
+            self.release_all(workers)
+
+    def acquire_all(self):
+        with self.lock:
+            return [self.idle_workers.get() for _ in range(len(self.workers))]
+
+    def release_all(self, workers):
+        for worker in workers:
+            self.idle_workers.put(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
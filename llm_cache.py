@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+def get_prompt_hash(messages):
+    # The rendered messages (role and content) of a prompt, e.g., the messages of a ChatPromptValue
+    content = json.dumps([[message.type, message.content] for message in messages], ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+        Responses of the model in a single SQLite file, keyed by (model, temperature, prompt hash, sample index).
+
+        The sample index counts the requests of the same prompt within a repair of a bug, so a rerun replays the
+        responses in the order they were first received. When the responses exceed max_bytes, the least recently
+        used ones are removed.
+    """
+
+    def __init__(self, db_path, max_bytes):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        dir_path = os.path.dirname(db_path)
+        if dir_path != "" and not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS responses (model TEXT NOT NULL, temperature REAL NOT NULL, "
+                         "prompt_hash TEXT NOT NULL, sample INTEGER NOT NULL, data BLOB NOT NULL, "
+                         "size INTEGER NOT NULL, last_used REAL NOT NULL, "
+                         "PRIMARY KEY (model, temperature, prompt_hash, sample))")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    def connect(self):
+        # sqlite connections can be shared neither by threads nor by forked processes
+        if getattr(self.local, "conn", None) is None or self.local.pid != os.getpid():
+            self.local.conn = sqlite3.connect(self.db_path, timeout=60)
+            self.local.conn.execute("PRAGMA journal_mode=WAL")
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def get(self, model, temperature, prompt_hash, sample):
+        key = (model, temperature, prompt_hash, sample)
+        with self.connect() as conn:
+            row = conn.execute("SELECT data FROM responses WHERE model = ? AND temperature = ? AND prompt_hash = ? "
+                               "AND sample = ?", key).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE model = ? AND temperature = ? "
+                         "AND prompt_hash = ? AND sample = ?", (time.time(),) + key)
+        return pickle.loads(row[0])
+
+    def put(self, model, temperature, prompt_hash, sample, response):
+        data = pickle.dumps(response)
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (model, temperature, prompt_hash, sample, data, len(data), time.time()))
+        self.evict()
+
+    def evict(self):
+        with self.connect() as conn:
+            total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total_size <= self.max_bytes:
+                return
+            removed_size = 0
+            rows = conn.execute("SELECT rowid, size FROM responses ORDER BY last_used").fetchall()
+            removed_rows = []
+            for rowid, size in rows:
+                if total_size - removed_size <= self.max_bytes:
+                    break
+                removed_rows.append((rowid,))
+                removed_size += size
+            conn.executemany("DELETE FROM responses WHERE rowid = ?", removed_rows)
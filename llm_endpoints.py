@@ -0,0 +1,132 @@
+import threading
+import time
+
+from llm_gateway import RETRYABLE_ERRORS
+
+EWMA_ALPHA = 0.3
+MAX_CONSECUTIVE_FAILURES = 3
+BASE_EJECTION_TIME = 30
+MAX_EJECTION_TIME = 600
+HEALTH_CHECK_TIMEOUT = 10
+
+
+class Endpoint:
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+        self.in_flight = 0
+        self.latency = None
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self.needs_check = False
+        self.calls = 0
+        self.failures = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def is_available(self, now):
+        return self.ejected_until <= now and not self.needs_check
+
+    def get_score(self):
+        # Expected wait of a new request: the requests in flight and this one, at the smoothed latency
+        return (self.in_flight + 1) * (self.latency if self.latency is not None else 0)
+
+
+class EndpointPool:
+    """
+        Several endpoints (inference servers) of the same model, used like a single chat model.
+
+        A request goes to the endpoint with the least load, i.e., requests in flight times its smoothed latency. An
+        endpoint that fails MAX_CONSECUTIVE_FAILURES requests in a row is ejected for a time that doubles with each
+        ejection, and is only used again once a health check of it succeeds.
+    """
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            endpoints = [endpoint for endpoint in self.endpoints if endpoint.is_available(now)]
+            if len(endpoints) == 0:
+                # Every endpoint is ejected, rather try the one that comes back first than fail the repair
+                endpoints = [min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)]
+            endpoint = min(endpoints, key=lambda endpoint: (endpoint.get_score(), endpoint.in_flight))
+            endpoint.in_flight += 1
+            return endpoint
+
+    def release(self, endpoint, start_time, response=None, error=None):
+        with self.lock:
+            endpoint.in_flight -= 1
+            endpoint.calls += 1
+            if error is None:
+                latency = time.time() - start_time
+                endpoint.latency = latency if endpoint.latency is None else \
+                    EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * endpoint.latency
+                endpoint.consecutive_failures = 0
+                endpoint.ejections = 0
+                token_usage = response.response_metadata.get('token_usage') or {}
+                endpoint.prompt_tokens += token_usage.get('prompt_tokens') or 0
+                endpoint.completion_tokens += token_usage.get('completion_tokens') or 0
+            elif isinstance(error, RETRYABLE_ERRORS):
+                # Errors of the request itself (e.g., a bad prompt) do not count against the endpoint
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                    self.eject(endpoint)
+
+    def eject(self, endpoint):
+        ejection_time = min(MAX_EJECTION_TIME, BASE_EJECTION_TIME * 2 ** endpoint.ejections)
+        endpoint.ejections += 1
+        endpoint.consecutive_failures = 0
+        endpoint.ejected_until = time.time() + ejection_time
+        endpoint.needs_check = True
+        print(f"Eject the LLM endpoint {endpoint.name} for {ejection_time} s.")
+
+    def check_health(self):
+        """ Lists the models of the ejected endpoints whose ejection time is over, brings back the ones that answer. """
+        now = time.time()
+        for endpoint in self.endpoints:
+            if not endpoint.needs_check or endpoint.ejected_until > now:
+                continue
+            try:
+                endpoint.model.root_client.with_options(timeout=HEALTH_CHECK_TIMEOUT, max_retries=0).models.list()
+                with self.lock:
+                    endpoint.needs_check = False
+                print(f"The LLM endpoint {endpoint.name} is healthy again.")
+            except Exception as e:
+                with self.lock:
+                    self.eject(endpoint)
+                print(f"The health check of the LLM endpoint {endpoint.name} failed: {e}")
+
+    def invoke(self, prompt_input):
+        self.check_health()
+        endpoint = self.acquire()
+        start_time = time.time()
+        try:
+            response = endpoint.model.invoke(prompt_input)
+        except Exception as e:
+            self.release(endpoint, start_time, error=e)
+            raise
+        self.release(endpoint, start_time, response)
+        return response
+
+    async def ainvoke(self, prompt_input):
+        self.check_health()
+        endpoint = self.acquire()
+        start_time = time.time()
+        try:
+            response = await endpoint.model.ainvoke(prompt_input)
+        except Exception as e:
+            self.release(endpoint, start_time, error=e)
+            raise
+        self.release(endpoint, start_time, response)
+        return response
+
+    def summarize(self):
+        with self.lock:
+            return "; ".join(f"{endpoint.name}: {endpoint.calls} calls, {endpoint.failures} failures, "
+                             f"latency {endpoint.latency or 0:.2f} s, prompt tokens {endpoint.prompt_tokens}, "
+                             f"completion tokens {endpoint.completion_tokens}" for endpoint in self.endpoints)
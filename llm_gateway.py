@@ -0,0 +1,177 @@
+import asyncio
+import multiprocessing
+import random
+import threading
+import time
+
+import openai
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError, TimeoutError)
+
+
+def create_shared_state(max_in_flight):
+    """
+        The in-flight semaphore and the rate limiter buckets, created before the worker processes are started and
+        passed to them, so that all the workers of a run share the same limits.
+    """
+    return {"semaphore": multiprocessing.BoundedSemaphore(max(1, max_in_flight)),
+            "lock": multiprocessing.Lock(),
+            "requests": multiprocessing.Value('d', 0.0, lock=False),
+            "tokens": multiprocessing.Value('d', 0.0, lock=False),
+            "last_refill": multiprocessing.Value('d', 0.0, lock=False)}
+
+
+class TokenBucket:
+    """ Requests per minute and tokens per minute, either limit is disabled when it is None. """
+
+    def __init__(self, shared_state, rpm=None, tpm=None):
+        self.lock = shared_state.get("lock")
+        self.requests = shared_state.get("requests")
+        self.tokens = shared_state.get("tokens")
+        self.last_refill = shared_state.get("last_refill")
+        self.rpm = rpm
+        self.tpm = tpm
+
+    def refill(self):
+        now = time.time()
+        if self.last_refill.value == 0:
+            # The buckets start full
+            elapsed = float("inf")
+        else:
+            elapsed = now - self.last_refill.value
+        if self.rpm is not None:
+            self.requests.value = min(self.rpm, self.requests.value + elapsed * self.rpm / 60)
+        if self.tpm is not None:
+            self.tokens.value = min(self.tpm, self.tokens.value + elapsed * self.tpm / 60)
+        self.last_refill.value = now
+
+    def get_wait_time(self, tokens):
+        with self.lock:
+            self.refill()
+            # A prompt larger than the whole bucket waits for a full bucket instead of forever
+            tokens = min(tokens, self.tpm) if self.tpm is not None else tokens
+            wait_time = 0
+            if self.rpm is not None and self.requests.value < 1:
+                wait_time = max(wait_time, (1 - self.requests.value) * 60 / self.rpm)
+            if self.tpm is not None and self.tokens.value < tokens:
+                wait_time = max(wait_time, (tokens - self.tokens.value) * 60 / self.tpm)
+            if wait_time == 0:
+                if self.rpm is not None:
+                    self.requests.value -= 1
+                if self.tpm is not None:
+                    self.tokens.value -= tokens
+            return wait_time
+
+    def acquire(self, tokens):
+        while True:
+            wait_time = self.get_wait_time(tokens)
+            if wait_time == 0:
+                return
+            time.sleep(wait_time)
+
+    async def acquire_async(self, tokens):
+        while True:
+            wait_time = self.get_wait_time(tokens)
+            if wait_time == 0:
+                return
+            await asyncio.sleep(wait_time)
+
+    def consume(self, tokens):
+        # Charges the tokens that were not known before the call, i.e., the completion tokens
+        if self.tpm is not None:
+            with self.lock:
+                self.tokens.value -= tokens
+
+
+class LLMGateway:
+    """
+        Wraps a chat model with a limit of the requests in flight, a token bucket rate limiter, retries of rate limit,
+        timeout and server errors with jittered exponential backoff, and per-call latency and token metrics.
+    """
+
+    def __init__(self, model, shared_state, rpm=None, tpm=None, count_tokens=None, max_retries=5, base_delay=1.0,
+                 max_delay=60.0):
+        self.model = model
+        self.semaphore = shared_state.get("semaphore")
+        self.bucket = TokenBucket(shared_state, rpm, tpm)
+        self.count_tokens = count_tokens if count_tokens is not None else (lambda text: len(text) // 4)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = []
+        self.metrics_lock = threading.Lock()
+
+    def estimate_tokens(self, prompt_input):
+        return sum(self.count_tokens(str(message.content)) for message in prompt_input.to_messages())
+
+    def get_retry_delay(self, attempt):
+        # Full jitter, so that workers throttled at the same time do not retry at the same time
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def invoke(self, prompt_input):
+        estimated_tokens = self.estimate_tokens(prompt_input)
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire(estimated_tokens)
+            self.semaphore.acquire()
+            start_time = time.time()
+            try:
+                response = self.model.invoke(prompt_input)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                self.log_retry(e, attempt)
+            else:
+                self.record(response, start_time, attempt + 1, estimated_tokens)
+                return response
+            finally:
+                self.semaphore.release()
+            time.sleep(self.get_retry_delay(attempt))
+
+    async def ainvoke(self, prompt_input):
+        estimated_tokens = self.estimate_tokens(prompt_input)
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire_async(estimated_tokens)
+            # The semaphore is shared with other processes, it cannot be awaited
+            await asyncio.to_thread(self.semaphore.acquire)
+            start_time = time.time()
+            try:
+                response = await self.model.ainvoke(prompt_input)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                self.log_retry(e, attempt)
+            else:
+                self.record(response, start_time, attempt + 1, estimated_tokens)
+                return response
+            finally:
+                self.semaphore.release()
+            await asyncio.sleep(self.get_retry_delay(attempt))
+
+    def log_retry(self, error, attempt):
+        print(f"The model request failed ({type(error).__name__}: {error}), retry {attempt + 1}/{self.max_retries}.")
+
+    def record(self, response, start_time, attempts, estimated_tokens):
+        token_usage = response.response_metadata.get('token_usage') or {}
+        prompt_tokens = token_usage.get('prompt_tokens') or 0
+        completion_tokens = token_usage.get('completion_tokens') or 0
+        if prompt_tokens + completion_tokens > 0:
+            self.bucket.consume(prompt_tokens + completion_tokens - estimated_tokens)
+        with self.metrics_lock:
+            self.metrics.append({"latency": time.time() - start_time, "attempts": attempts,
+                                 "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+
+    def pop_metrics(self):
+        with self.metrics_lock:
+            metrics, self.metrics = self.metrics, []
+        return metrics
+
+
+def summarize_metrics(metrics):
+    if len(metrics) == 0:
+        return "LLM calls: 0"
+    latencies = sorted(metric.get("latency") for metric in metrics)
+    return (f"LLM calls: {len(metrics)}, retries: {sum(metric.get('attempts') - 1 for metric in metrics)}, "
+            f"mean latency: {sum(latencies) / len(latencies):.2f} s, "
+            f"max latency: {latencies[-1]:.2f} s, "
+            f"prompt tokens: {sum(metric.get('prompt_tokens') for metric in metrics)}, "
+            f"completion tokens: {sum(metric.get('completion_tokens') for metric in metrics)}")
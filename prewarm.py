@@ -0,0 +1,95 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import utils
+from basic_framework.main_nodes import prepare_analysis_info
+from basic_framework.program_analysis import key_token_mining_batch, release_program_analyzers
+from benchmark.benchmark import BenchmarkRegistry
+from logger import Logger
+
+PREWARM_ARTIFACT = "prewarm_timings"
+worker_benchmark = None
+
+
+def prewarm_single_bug(dataset, bug_id, benchmark):
+    """
+        Checks out a bug and fills the artifact store with its failing tests, program analysis results and key
+        tokens, so that later repair runs of the bug start without analysis latency. Returns the timings.
+    """
+    if utils.get_artifact_store().has(dataset, bug_id, [PREWARM_ARTIFACT], utils.get_extractor_version()):
+        print(f"Has already analyzed {bug_id}, skipping...")
+        return None
+    log_dir = os.path.join("output", "prewarm", dataset)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+    utils.Repair_Process_Logger = Logger(os.path.join(log_dir, f"{bug_id}.log"))
+    utils.test_cases_codes_map = utils.load_test_cases_codes_map(dataset, bug_id)
+    timings = {}
+    start_time = time.time()
+    benchmark.checkout(bug_id)
+    timings["checkout"] = time.time() - start_time
+    try:
+        step_time = time.time()
+        signature_method_map, _, _ = prepare_analysis_info(benchmark, dataset, bug_id,
+                                                           list(benchmark.get_init_failing_tests().keys()))
+        timings["program_analysis"] = time.time() - step_time
+        step_time = time.time()
+        _, fault_files = utils.codes_format_transform(list(signature_method_map.values()))
+        key_token_mining_batch(benchmark.get_work_dir(), fault_files)
+        timings["key_token_mining"] = time.time() - step_time
+        utils.output_test_cases_codes_map(dataset, bug_id)
+        timings["total"] = time.time() - start_time
+        utils.get_artifact_store().put(dataset, bug_id, PREWARM_ARTIFACT, timings, utils.get_extractor_version())
+    finally:
+        release_program_analyzers(benchmark.get_work_dir())
+        benchmark.remove_clones()
+        utils.remove_temp_dir(benchmark.get_work_dir())
+    return timings
+
+
+def init_worker(dataset):
+    global worker_benchmark
+    utils.WORKER_TEMP_DIR = f"worker-{os.getpid()}"
+    worker_benchmark = BenchmarkRegistry.create_benchmark(dataset)
+
+
+def prewarm_in_worker(dataset, bug_id):
+    try:
+        return prewarm_single_bug(dataset, bug_id, worker_benchmark)
+    except Exception as e:
+        print(f"Failed to analyze {bug_id}: {e}")
+        return None
+
+
+def print_timings(bug_id, timings):
+    if timings is not None:
+        print(f"{bug_id}: " + ", ".join(f"{step} {cost:.1f} s" for step, cost in timings.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Analyze all the bugs of a dataset ahead of the repair runs.")
+    parser.add_argument("--dataset", type=str, default="defects4jv1.2",
+                        help="Dataset to use, current support: defects4jv1.2, defects4jv2, defects4j-trans, gitbug-java")
+    parser.add_argument("--bug_id", type=str, default="all")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.bug_id == "all":
+        bugs = BenchmarkRegistry.create_benchmark(args.dataset).get_all_bugs()
+    else:
+        bugs = args.bug_id.split(",")
+    # Create the store (and import the shipped results) before the workers race for it
+    utils.get_artifact_store()
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(args.dataset,)) as executor:
+            futures = {executor.submit(prewarm_in_worker, args.dataset, bug): bug for bug in bugs}
+            for future in as_completed(futures):
+                print_timings(futures[future], future.result())
+    else:
+        init_worker(args.dataset)
+        utils.WORKER_TEMP_DIR = ""
+        for bug in bugs:
+            print_timings(bug, prewarm_in_worker(args.dataset, bug))
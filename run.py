@@ -2,16 +2,34 @@ import argparse
 import csv
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import utils
 from basic_framework.main_graph import main_agent
+from basic_framework.program_analysis import release_program_analyzers
 from basic_framework.repair_graph import get_repair_agent
 from benchmark.benchmark import BenchmarkRegistry
+from llm_gateway import summarize_metrics
 from logger import Logger
 
+RESULT_HEADER = ["Bug_id", "Repair_Result", "Repair_Attempt_Count", "Repair_Iterative_Count",
+                 "Last_Input_Prompt_Tokens", "Last_Completion_Tokens", "Total_Input_Prompt_Tokens",
+                 "Total_Completion_Tokens", "LLM_Cache_Hits", "LLM_Cache_Misses"]
+worker_benchmark = None
+
+
+def get_output_dir(version_name, dataset):
+    return "output" + os.sep + utils.MODEL_NAME + os.sep + version_name + os.sep + dataset
+
+
+def read_repair_result(repair_result_file):
+    with open(repair_result_file, 'r', newline='', encoding='utf-8') as file:
+        rows = list(csv.reader(file))
+    return rows[-1] if len(rows) > 1 else None
+
 
 def run_repair_single_bug(max_tries, version_name, dataset, bug_id, benchmark):
-    utils.OUTPUT_DIR = "output" + os.sep + utils.MODEL_NAME + os.sep + version_name + os.sep + dataset
+    utils.OUTPUT_DIR = get_output_dir(version_name, dataset)
     start_time = time.time()
     if not os.path.exists(utils.OUTPUT_DIR):
         os.makedirs(utils.OUTPUT_DIR)
@@ -21,8 +39,9 @@ def run_repair_single_bug(max_tries, version_name, dataset, bug_id, benchmark):
         os.makedirs(os.path.join(utils.OUTPUT_DIR, bug_id))
     elif os.path.exists(repair_result_file):
         print(f"Has already repaired {bug_id}, ending...")
-        return
+        return read_repair_result(repair_result_file)
     print(f"Repairing {bug_id}...")
+    utils.reset_repair_state()
     utils.test_cases_codes_map = utils.load_test_cases_codes_map(dataset, bug_id)
 
     repair_count = 0
@@ -32,31 +51,103 @@ def run_repair_single_bug(max_tries, version_name, dataset, bug_id, benchmark):
         benchmark.checkout(bug_id)
     except Exception as e:
         print(str(e))
-        return
+        return None
     while (not utils.Repair_Result) and repair_count < max_tries:
         main_agent.invoke({'bug_id': bug_id, "database_name": dataset,
                            'failed_test_cases': benchmark.get_init_failing_tests(),
                            'bug_benchmark': benchmark}, {"recursion_limit": 100})
         repair_count += 1
-    rows = ["Bug_id", "Repair_Result", "Repair_Attempt_Count", "Repair_Iterative_Count",
-            "Last_Input_Prompt_Tokens", "Last_Completion_Tokens", "Total_Input_Prompt_Tokens",
-            "Total_Completion_Tokens"]  # time.sleep(20)
     row = [f"{bug_id}", utils.Repair_Result, repair_count, utils.Repair_Iterative_Count, utils.Prompt_Tokens,
-           utils.Completion_Tokens, utils.Total_Prompt_Token, utils.Total_Completion_Token]
+           utils.Completion_Tokens, utils.Total_Prompt_Token, utils.Total_Completion_Token, utils.LLM_Cache_Hits,
+           utils.LLM_Cache_Misses]
     with open(repair_result_file, mode='a', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
-        writer.writerow(rows)
+        writer.writerow(RESULT_HEADER)
         writer.writerow(row)
     end_time = time.time()
+    utils.Repair_Process_Logger.log(summarize_metrics(utils.get_llm_gateway().pop_metrics()))
+    if utils.llm_endpoint_pool is not None:
+        utils.Repair_Process_Logger.log(f"LLM endpoints: {utils.llm_endpoint_pool.summarize()}")
     utils.Repair_Process_Logger.log(f"Total Time: {end_time - start_time} s.")
+    release_program_analyzers(benchmark.get_work_dir())
+    benchmark.release_runners()
+    benchmark.remove_clones()
     utils.remove_temp_dir(benchmark.get_work_dir())
     utils.output_test_cases_codes_map(dataset, bug_id)
-    utils.Repair_Result = False
-    utils.Repair_Iterative_Count = 0
-    utils.Prompt_Tokens = 0
-    utils.Completion_Tokens = 0
-    utils.Total_Prompt_Token = 0
-    utils.Total_Completion_Token = 0
+    utils.reset_repair_state()
+    return row
+
+
+def configure(args):
+    utils.MAX_ITERATIONS = args.chain_length
+    utils.Enable_FMC = args.faulty_methods_clustering
+    utils.Enable_CX = args.context_extraction
+    utils.Enable_DualAgent = args.dual_agent_based_patch_generation
+    utils.AGENT_WORKERS = args.agent_workers
+    utils.VALIDATION_WORKERS = args.validation_workers
+    utils.ANALYSIS_WORKERS = args.analysis_workers
+    utils.TEST_BACKEND = args.test_backend
+    utils.TEST_SHARDS = args.test_shards
+    utils.VALIDATION_CACHE = not args.no_validation_cache
+    utils.LLM_CACHE_MODE = args.llm_cache
+    utils.SAMPLES = args.samples
+    utils.PROMPT_BUDGET = args.prompt_budget
+    utils.repair_agent = get_repair_agent()
+    if utils.MAX_ITERATIONS > 1:
+        utils.Test_Case_Prompt = True
+    if utils.Enable_CX:
+        utils.Invocation_Chain_Prompt = True
+        utils.Similar_Codes_Prompt = True
+        utils.key_token_prompt = True
+    utils.reset_repair_state()
+
+
+def init_worker(args, llm_gateway_state):
+    # Every worker owns its utils state and checks bugs out under its own temp sub-root
+    global worker_benchmark
+    configure(args)
+    utils.llm_gateway_state = llm_gateway_state
+    utils.WORKER_TEMP_DIR = f"worker-{os.getpid()}"
+    utils.test_cases_codes_map = {}
+    utils.Repair_Process_Logger = None
+    worker_benchmark = BenchmarkRegistry.create_benchmark(args.dataset)
+
+
+def run_repair_in_worker(max_tries, version_name, dataset, bug_id):
+    try:
+        return run_repair_single_bug(max_tries, version_name, dataset, bug_id, worker_benchmark)
+    except Exception as e:
+        print(f"Failed to repair {bug_id}: {e}")
+        return None
+
+
+def run_repair_parallel(args, version_name, bugs):
+    rows = {}
+    # The workers share the limits of the requests to the model
+    llm_gateway_state = utils.create_llm_gateway_state()
+    # The store is created (and the shipped analysis results imported) once, before the workers open it
+    utils.get_artifact_store()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(args, llm_gateway_state)) as executor:
+        futures = {executor.submit(run_repair_in_worker, args.total_tries, version_name, args.dataset, bug): bug
+                   for bug in bugs}
+        for future in as_completed(futures):
+            bug = futures[future]
+            rows[bug] = future.result()
+            print(f"Finished {bug} ({len(rows)}/{len(bugs)})")
+    write_summary(version_name, args.dataset, [rows[bug] for bug in bugs if rows.get(bug) is not None])
+
+
+def write_summary(version_name, dataset, rows):
+    output_dir = get_output_dir(version_name, dataset)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    summary_file = os.path.join(output_dir, f"summary-{utils.MAX_ITERATIONS}.csv")
+    with open(summary_file, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(RESULT_HEADER)
+        writer.writerows(rows)
+    print(f"Summary of {len(rows)} bugs is written to {summary_file}")
 
 
 if __name__ == '__main__':
@@ -71,6 +162,26 @@ if __name__ == '__main__':
     parser.add_argument("--chain_length", type=int, default=5)
     parser.add_argument("--total_tries", type=int, default=3)
     parser.add_argument("--max_token", type=int, default=8192)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes used to repair bugs in parallel when bug_id is all.")
+    parser.add_argument("--agent_workers", type=int, default=1,
+                        help="number of repair agents of the same bug that are run concurrently.")
+    parser.add_argument("--validation_workers", type=int, default=1,
+                        help="number of merged agent groups of the same bug that are validated concurrently.")
+    parser.add_argument("--analysis_workers", type=int, default=1,
+                        help="number of JVM processes kept by the program analysis service.")
+    parser.add_argument("--test_backend", type=str, default="defects4j", choices=["defects4j", "junit"],
+                        help="run the tests of candidate patches with defects4j test or a warm JUnit JVM.")
+    parser.add_argument("--test_shards", type=int, default=1,
+                        help="number of JUnit JVMs the whole test suite of a candidate patch is split over.")
+    parser.add_argument("--no_validation_cache", action="store_true",
+                        help="compile and test every repair, even if the same repair has been validated before.")
+    parser.add_argument("--prompt_budget", type=int, default=32768,
+                        help="maximum tokens of a prompt, lower priority context is shrunk or dropped to fit.")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="number of candidate repairs requested from the model concurrently at each repair step.")
+    parser.add_argument("--llm_cache", type=str, default="rw", choices=["rw", "ro", "off"],
+                        help="replay and store the responses of the model (rw), only replay them (ro), or neither.")
     parser.add_argument("-f", "--faulty_methods_clustering", help="flag that enable faulty methods clustering.",
                         action="store_true", default=False)
     parser.add_argument("-c", "--context_extraction", help="flag that enable context extraction.",
@@ -88,30 +199,18 @@ if __name__ == '__main__':
     #                     action="store_true", default=False)
 
     args = parser.parse_args()
-    utils.MAX_ITERATIONS = args.chain_length
-    utils.Enable_FMC = args.faulty_methods_clustering
-    utils.Enable_CX = args.context_extraction
-    utils.Enable_DualAgent = args.dual_agent_based_patch_generation
-    utils.repair_agent = get_repair_agent()
-    if utils.MAX_ITERATIONS > 1:
-        utils.Test_Case_Prompt = True
-    if utils.Enable_CX:
-        utils.Invocation_Chain_Prompt = True
-        utils.Similar_Codes_Prompt = True
-        utils.key_token_prompt = True
-    utils.Repair_Result = False
-    utils.Repair_Iterative_Count = 0
-    utils.Prompt_Tokens = 0
-    utils.Completion_Tokens = 0
-    utils.Total_Prompt_Token = 0
-    utils.Total_Completion_Token = 0
+    configure(args)
     version_name = utils.get_version_name()
 
     cur_benchmark = BenchmarkRegistry.create_benchmark(args.dataset)
 
     if args.bug_id == "all":
         bug_to_be_repaired = cur_benchmark.get_all_bugs()
-        for bug in bug_to_be_repaired:
-            run_repair_single_bug(args.total_tries, version_name, args.dataset, bug, cur_benchmark)
+        if args.workers > 1:
+            run_repair_parallel(args, version_name, bug_to_be_repaired)
+        else:
+            rows = [run_repair_single_bug(args.total_tries, version_name, args.dataset, bug, cur_benchmark)
+                    for bug in bug_to_be_repaired]
+            write_summary(version_name, args.dataset, [row for row in rows if row is not None])
     else:
         run_repair_single_bug(args.total_tries, version_name, args.dataset, args.bug_id, cur_benchmark)
@@ -0,0 +1,85 @@
+import utils
+from artifact_store import ArtifactStore
+from benchmark import defects4j
+from benchmark.defects4j import parse_failing_tests
+
+CLASS_LEVEL_FAILING_TESTS = "\n".join([
+    "--- org.Foo",
+    "java.lang.ExceptionInInitializerError",
+    "\tat org.Foo.<clinit>(Foo.java:10)",
+    "--- org.Bar::testA",
+    "junit.framework.AssertionFailedError: expected:<1> but was:<2>",
+    "\tat org.Bar.testA(Bar.java:20)",
+    ""])
+
+
+def write_failing_tests(working_dir):
+    (working_dir / "failing_tests").write_text(CLASS_LEVEL_FAILING_TESTS)
+    (working_dir / "test" / "org").mkdir(parents=True, exist_ok=True)
+    (working_dir / "test" / "org" / "Bar.java").write_text(
+        "package org;\n\npublic class Bar {\n    public void testA() {\n    }\n}\n")
+
+
+def test_parse_failing_tests_keeps_class_level_failures(tmp_path):
+    write_failing_tests(tmp_path)
+    assert list(parse_failing_tests(str(tmp_path), "test")) == ["org.Foo", "org.Bar::testA"]
+
+
+def test_recent_failing_tests_only_keep_test_methods(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "artifact_store", ArtifactStore(str(tmp_path / "artifacts.sqlite3")))
+    write_failing_tests(tmp_path)
+    utils.save_recent_failing_tests("defects4jv1.2", "Lang-1", list(parse_failing_tests(str(tmp_path), "test")))
+    assert utils.load_recent_failing_tests("defects4jv1.2", "Lang-1") == ["org.Bar::testA"]
+
+
+def test_class_level_entries_stored_before_are_not_loaded(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "artifact_store", ArtifactStore(str(tmp_path / "artifacts.sqlite3")))
+    utils.get_artifact_store().put("defects4jv1.2", "Lang-1", "recent_failing_tests", ["org.Foo", "org.Bar::testA"])
+    assert utils.load_recent_failing_tests("defects4jv1.2", "Lang-1") == ["org.Bar::testA"]
+
+
+def test_run_test_cases_skips_class_level_names(monkeypatch):
+    batches = []
+
+    def run_test_batch(database_name, working_dir, test_source_dir, test_class, test_methods):
+        batches.append((test_class, test_methods))
+        return {}
+
+    monkeypatch.setattr(defects4j, "run_test_batch", run_test_batch)
+    assert defects4j.run_test_cases("defects4jv1.2", "work_dir", "test", ["org.Foo", "org.Bar::testA"]) == {}
+    assert batches == [("org.Bar", ["testA"])]
+
+
+def test_junit_runs_class_level_names_as_whole_classes(monkeypatch):
+    requests = []
+
+    def run_junit_tests(self, test_classes, timeout=None):
+        requests.append(test_classes)
+        return {"org.Foo::initializationError": "java.lang.ExceptionInInitializerError"}, {}
+
+    monkeypatch.setattr(utils, "TEST_BACKEND", "junit")
+    monkeypatch.setattr(defects4j.Defects4j, "run_junit_tests", run_junit_tests)
+    monkeypatch.setattr(utils, "get_test_code", lambda *args: "")
+    bug_benchmark = defects4j.Defects4j("defects4jv1.2")
+    test_result = bug_benchmark.test_failed_test_cases(["org.Foo::testB", "org.Foo", "org.Bar::testA"])
+    assert requests == [{"org.Foo": None, "org.Bar": ["testA"]}]
+    assert list(test_result) == ["org.Foo::initializationError"]
+
+
+def test_blank_test_classes_are_dropped_and_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "artifact_store", ArtifactStore(str(tmp_path / "artifacts.sqlite3")))
+    monkeypatch.setattr(defects4j, "export_properties", lambda *args: {"tests.all": "\n  \n"})
+    assert defects4j.get_all_test_classes("defects4jv1.2", "work_dir", "Lang-1") == []
+    assert utils.get_artifact_store().get("defects4jv1.2", "Lang-1", defects4j.ALL_TESTS_ARTIFACT) is None
+    monkeypatch.setattr(defects4j, "export_properties", lambda *args: {"tests.all": "org.BarTest\n\norg.FooTest\n"})
+    assert defects4j.get_all_test_classes("defects4jv1.2", "work_dir", "Lang-1") == ["org.BarTest", "org.FooTest"]
+
+
+def test_sharded_run_without_test_classes_falls_back_to_defects4j(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "artifact_store", ArtifactStore(str(tmp_path / "artifacts.sqlite3")))
+    monkeypatch.setattr(utils, "TEST_BACKEND", "junit")
+    monkeypatch.setattr(defects4j, "export_properties", lambda *args: {"tests.all": ""})
+    monkeypatch.setattr(defects4j, "test_project", lambda *args, **kwargs: (2, {}))
+    bug_benchmark = defects4j.Defects4j("defects4jv1.2")
+    bug_benchmark.bug_id = "Lang-1"
+    assert bug_benchmark.test_project() == (2, {})
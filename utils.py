@@ -2,13 +2,23 @@ import os
 import json
 import shutil
 import difflib
-import pickle
+import hashlib
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
+import javalang
 from langchain_openai import ChatOpenAI
 import tiktoken
 import jpype
-import multiprocessing
+import atexit
+
+from artifact_store import ArtifactStore
+from jvm_service import JVMService
+from llm_cache import LLMCache, get_prompt_hash
+from llm_endpoints import Endpoint, EndpointPool
+from llm_gateway import LLMGateway, create_shared_state
 
 
 def read_json(filepath):
@@ -40,8 +50,14 @@ def get_custom_llm():
     # if model_name == "Qwen2.5-72B-Local":
     #     return ChatOpenAI(openai_api_key="EMPTY", openai_api_base="http://114.212.170.115:11288/v1",
     #                model_name="Qwen2.5-72B", temperature=1), model_name
-    return ChatOpenAI(openai_api_key=config[model_name].get("api_key"), openai_api_base=config[model_name].get("base_url"),
-                   model_name=config[model_name].get("model_name"), temperature=1), model_name
+    return create_chat_model(config[model_name].get("api_key"), config[model_name].get("base_url"),
+                             config[model_name].get("model_name")), model_name
+
+
+def create_chat_model(api_key, base_url, model_name):
+    # Requests are retried by the LLM gateway, which also backs off and rate limits them
+    return ChatOpenAI(openai_api_key=api_key, openai_api_base=base_url, model_name=model_name, temperature=1,
+                      max_retries=0)
 
 CUSTOM_MODEL, MODEL_NAME = get_custom_llm()
 ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -65,9 +81,69 @@ Prompt_Tokens = 0
 Completion_Tokens = 0
 Total_Prompt_Token = 0
 Total_Completion_Token = 0
+LLM_Cache_Hits = 0
+LLM_Cache_Misses = 0
 
 test_cases_codes_map = {}
 repair_agent = None
+# Sub-directory of the benchmark temp root used by the current worker process, empty when running serially
+WORKER_TEMP_DIR = ""
+# Number of repair agents of the same bug that are run concurrently, each in its own copy of the working directory
+AGENT_WORKERS = 1
+# Number of merged agent groups of the same bug that are validated concurrently, each in a leased working directory
+VALIDATION_WORKERS = 1
+# Number of JVM processes of the analysis service, which is started on first use and kept for the whole run
+ANALYSIS_WORKERS = 1
+# Seconds an analysis request may take (for a stream, until its next record), a hanging worker is then restarted
+ANALYSIS_TIMEOUT = 1800
+# Candidates failing at least this number of tests are discarded, the test run is stopped once it is reached
+FAILING_TEST_THRESHOLD = 30
+MAX_RECENT_FAILING_TESTS = 20
+# Backend that runs the tests of a candidate patch: "defects4j" (defects4j test) or "junit" (a warm JUnit JVM)
+TEST_BACKEND = "defects4j"
+# Number of JUnit JVMs the whole test suite is split over, by test class
+TEST_SHARDS = 1
+EXTRACTOR_JAR = os.path.join(ROOT_PATH, "java_lib", "context-extractor.jar")
+analysis_service = None
+extractor_version = None
+
+
+def get_extractor_version():
+    # Analysis results are only reusable with the extractor that produced them
+    global extractor_version
+    if extractor_version is None:
+        if os.path.exists(EXTRACTOR_JAR):
+            extractor_version = file_digest(EXTRACTOR_JAR)[:12]
+        else:
+            extractor_version = "unknown"
+    return extractor_version
+
+
+def file_digest(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_analysis_service():
+    global analysis_service
+    if analysis_service is None:
+        analysis_service = JVMService(ANALYSIS_WORKERS, EXTRACTOR_JAR, timeout=ANALYSIS_TIMEOUT)
+        atexit.register(analysis_service.stop)
+    return analysis_service
+
+
+def reset_repair_state():
+    global Repair_Result, Repair_Iterative_Count, Prompt_Tokens, Completion_Tokens, Total_Prompt_Token, \
+        Total_Completion_Token, LLM_Cache_Hits, LLM_Cache_Misses
+    Repair_Result = False
+    Repair_Iterative_Count = 0
+    Prompt_Tokens = 0
+    Completion_Tokens = 0
+    Total_Prompt_Token = 0
+    Total_Completion_Token = 0
+    LLM_Cache_Hits = 0
+    LLM_Cache_Misses = 0
+    prompt_samples.clear()
 
 
 def get_version_name():
@@ -108,11 +184,6 @@ def modify_files(base_dir, repair_results: list):
         modify_file(base_dir, file_path, repaired_snippets)
 
 
-def decode_code_list(code_list):
-    for i in range(len(code_list)):
-        code_list[i] = code_list[i].replace("irnlgkjidl", "'")
-
-
 def recover_files(base_dir, file_list):
     for file in file_list:
         recover_file(base_dir, file)
@@ -164,10 +235,14 @@ def recover_file(base_dir, file):
     print(f"Recover {file} successfully!")
 
 
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name='cl100k_base'):
+    return tiktoken.get_encoding(encoding_name)
+
+
 def encoding_count(input: str) -> int:
     """ token count """
-    encoding_name = 'cl100k_base'
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding()
     token_integers = encoding.encode(input)
     num_tokens = len(token_integers)
     return num_tokens
@@ -312,45 +387,222 @@ def get_all_similar_methods(fault_codes: dict):
 
 
 
+# Reuse the compile and test results of repairs that were validated before (by any run of the same bug)
+VALIDATION_CACHE = True
+# Failing infos and compile errors that come from the environment (timeouts, crashed tools), not from the patch
+TIMEOUT_ERROR = "Time out error"
+EXCEPTION_PREFIX = "Exception: "
+ENVIRONMENT_ERRORS = (TIMEOUT_ERROR, EXCEPTION_PREFIX, "Build Time Out!")
+# Number of candidate repairs requested from the model at each repair step
+SAMPLES = 1
+# Tokens of a rendered prompt, the context sections of longer prompts are shrunk to fit
+PROMPT_BUDGET = 32768
+# Tokens of the similar code snippets of a prompt, about the 3000 of the former length / 2 estimate
+SIMILAR_CODES_TOKENS = 1500
+PREPARE_ARTIFACTS = ("signature_method_map", "methods_tests_map", "method_test_path_map")
+artifact_store = None
+# Responses of the model are replayed from the cache ("rw"), only read from it ("ro") or not cached at all ("off")
+LLM_CACHE_MODE = "rw"
+LLM_CACHE_DIR = "llm_cache"
+LLM_CACHE_MAX_GB = 5
+llm_cache = None
+llm_cache_lock = threading.Lock()
+# Requests in flight to the model, shared by all the worker processes of a run
+LLM_MAX_IN_FLIGHT = 8
+llm_gateway = None
+llm_gateway_state = None
+llm_endpoint_pool = None
+# Number of requests of each prompt hash in the repair of the current bug
+prompt_samples = {}
+
+
+def get_artifact_store():
+    global artifact_store
+    if artifact_store is None:
+        db_path = os.path.join(ANALYSIS_DIR, "artifacts.sqlite3")
+        is_new = not os.path.exists(db_path)
+        artifact_store = ArtifactStore(db_path)
+        shipped_zip = os.path.join(ROOT_PATH, "analysis_output.zip")
+        if is_new and os.path.exists(shipped_zip):
+            print(f"Importing the shipped analysis results from {shipped_zip}...")
+            artifact_store.import_zip(shipped_zip, get_artifact_version)
+    return artifact_store
+
+
+def normalize_code(code):
+    # The tokens of the code, so that reformatted repairs match while string and char literals are kept as they are
+    try:
+        return "\n".join(token.value for token in javalang.tokenizer.tokenize(code))
+    except Exception:
+        return code
+
+
+def get_patch_hash(fault_code_infos, *extra_keys):
+    items = sorted(f"{fault_code_info.get('file_path')}:{fault_code_info.get('line_begin')}:"
+                   f"{normalize_code(str(fault_code_info.get('repaired_code', '')))}"
+                   for fault_code_info in fault_code_infos)
+    # The test results depend on the backend that ran the tests
+    keys = [TEST_BACKEND] + [str(key) for key in extra_keys]
+    return hashlib.sha256("\n".join(items + keys).encode("utf-8")).hexdigest()
+
+
+def load_validation_result(dataset, bug_id, stage, patch_hash):
+    if not VALIDATION_CACHE:
+        return None
+    return get_artifact_store().get(dataset, bug_id, f"validation/{stage}/{patch_hash}")
+
+
+def save_validation_result(dataset, bug_id, stage, patch_hash, result):
+    if VALIDATION_CACHE:
+        get_artifact_store().put(dataset, bug_id, f"validation/{stage}/{patch_hash}", result)
+
+
+def is_environment_error(info):
+    return str(info or "").startswith(ENVIRONMENT_ERRORS)
+
+
+def is_cacheable_compile_result(compile_result):
+    # Only the verdicts of the compiler are cached, a failed compiler run is tried again
+    return compile_result[0] or not is_environment_error(compile_result[1])
+
+
+def is_cacheable_test_result(test_result):
+    return not any(is_environment_error(failing_test.get("failing_info")) for failing_test in test_result.values())
+
+
+def is_test_method(test_name):
+    # "Class::method", unlike the class-level failures (e.g., of a static initializer) that name only the class
+    return "::" in str(test_name)
+
+
+def load_recent_failing_tests(dataset, bug_id):
+    return [test for test in get_artifact_store().get(dataset, bug_id, "recent_failing_tests", default=[])
+            if is_test_method(test)]
+
+
+def save_recent_failing_tests(dataset, bug_id, failing_tests):
+    # Tests that failed on earlier candidates of a bug, most recent first, are run before the slower test stages.
+    # Only test methods are kept, the stage runs them by name
+    failing_tests = [test for test in failing_tests if is_test_method(test)]
+    recent_failing_tests = failing_tests + [test for test in load_recent_failing_tests(dataset, bug_id)
+                                            if test not in failing_tests]
+    get_artifact_store().put(dataset, bug_id, "recent_failing_tests",
+                             recent_failing_tests[:MAX_RECENT_FAILING_TESTS])
+
+
+def get_llm_cache():
+    global llm_cache
+    if llm_cache is None:
+        llm_cache = LLMCache(os.path.join(LLM_CACHE_DIR, "responses.sqlite3"), int(LLM_CACHE_MAX_GB * 1024 ** 3))
+    return llm_cache
+
+
+def get_model_config():
+    # Besides the endpoint, optional "rpm", "tpm" and "max_in_flight" limits of the model
+    return read_json("Config/llm_config.json").get(MODEL_NAME) or {}
+
+
+def create_llm_gateway_state():
+    return create_shared_state(get_model_config().get("max_in_flight", LLM_MAX_IN_FLIGHT))
+
+
+def get_llm_endpoint_pool():
+    """
+        Several servers of the current model, listed in its "endpoints" field, each with a "base_url" and an optional
+        "api_key" (default is the api_key of the model). None if the model has no endpoints.
+    """
+    global llm_endpoint_pool
+    model_config = get_model_config()
+    if llm_endpoint_pool is None and len(model_config.get("endpoints") or []) > 0:
+        llm_endpoint_pool = EndpointPool([
+            Endpoint(endpoint.get("base_url"),
+                     create_chat_model(endpoint.get("api_key", model_config.get("api_key")), endpoint.get("base_url"),
+                                       model_config.get("model_name")))
+            for endpoint in model_config.get("endpoints")])
+    return llm_endpoint_pool
+
+
+def get_llm_gateway():
+    global llm_gateway, llm_gateway_state
+    if llm_gateway is None:
+        model_config = get_model_config()
+        if llm_gateway_state is None:
+            llm_gateway_state = create_llm_gateway_state()
+        llm_gateway = LLMGateway(get_llm_endpoint_pool() or CUSTOM_MODEL, llm_gateway_state, model_config.get("rpm"), model_config.get("tpm"),
+                                 encoding_count)
+    return llm_gateway
+
+
+def invoke_llm(prompt_input):
+    """ Invokes CUSTOM_MODEL with a rendered prompt, replaying the cached response of an earlier run if any. """
+    return invoke_llm_samples(prompt_input, 1)[0]
+
+
+def invoke_llm_samples(prompt_input, samples):
+    # Concurrent requests of the same prompt, each one is a different sample of the model
+    if LLM_CACHE_MODE == "off":
+        requests = [partial(get_llm_gateway().invoke, prompt_input) for _ in range(samples)]
+    else:
+        prompt_hash = get_prompt_hash(prompt_input.to_messages())
+        with llm_cache_lock:
+            # The sample indexes are reserved in order, so that a rerun replays the same responses
+            first_sample = prompt_samples.get(prompt_hash, 0)
+            prompt_samples[prompt_hash] = first_sample + samples
+        requests = [partial(invoke_llm_sample, prompt_input, prompt_hash, first_sample + i) for i in range(samples)]
+    if samples == 1:
+        return [requests[0]()]
+    with ThreadPoolExecutor(max_workers=samples) as executor:
+        return list(executor.map(lambda request: request(), requests))
+
+
+def invoke_llm_sample(prompt_input, prompt_hash, sample):
+    global LLM_Cache_Hits, LLM_Cache_Misses
+    model = f"{MODEL_NAME}/{CUSTOM_MODEL.model_name}"
+    temperature = float(CUSTOM_MODEL.temperature if CUSTOM_MODEL.temperature is not None else -1)
+    response = get_llm_cache().get(model, temperature, prompt_hash, sample)
+    with llm_cache_lock:
+        if response is not None:
+            LLM_Cache_Hits += 1
+        else:
+            LLM_Cache_Misses += 1
+    if response is None:
+        response = get_llm_gateway().invoke(prompt_input)
+        if LLM_CACHE_MODE == "rw":
+            get_llm_cache().put(model, temperature, prompt_hash, sample, response)
+    return response
+
+
+def get_artifact_version(artifact):
+    # Only the results of the program analysis depend on the extractor
+    if artifact in PREPARE_ARTIFACTS:
+        return get_extractor_version()
+    return ""
+
+
 def output_test_cases_codes_map(dataset, bug_id):
-    dir_path = os.path.join(ANALYSIS_DIR, dataset, bug_id)
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-    with open(os.path.join(dir_path, 'test_cases_codes_map.pickle'), 'wb') as file:
-        pickle.dump(test_cases_codes_map, file)
+    get_artifact_store().put(dataset, bug_id, "test_cases_codes_map", test_cases_codes_map,
+                             get_artifact_version("test_cases_codes_map"))
 
 
 def load_test_cases_codes_map(dataset, bug_id):
-    dir_path = os.path.join(ANALYSIS_DIR, dataset, bug_id)
-    if os.path.exists(os.path.join(dir_path, 'test_cases_codes_map.pickle')):
-        with open(os.path.join(dir_path, 'test_cases_codes_map.pickle'), 'rb') as file:
-            return pickle.load(file)
-    else:
-        return {}
+    return get_artifact_store().get(dataset, bug_id, "test_cases_codes_map",
+                                    get_artifact_version("test_cases_codes_map"), {})
 
 
 def output_prepare_info(dataset, bug_id, signature_method_map, methods_tests_map,
                         method_test_path_map):
-    dir_path = os.path.join(ANALYSIS_DIR, dataset, bug_id)
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-    # with open(os.path.join(dir_path, 'initial_failing_tests.pickle'), 'wb') as file:
-    #     pickle.dump(failed_tests, file)
-    with open(os.path.join(dir_path, 'signature_method_map.pickle'), 'wb') as file:
-        pickle.dump(signature_method_map, file)
-    with open(os.path.join(dir_path, 'methods_tests_map.pickle'), 'wb') as file:
-        pickle.dump(methods_tests_map, file)
-    with open(os.path.join(dir_path, 'method_test_path_map.pickle'), 'wb') as file:
-        pickle.dump(method_test_path_map, file)
+    get_artifact_store().put_many(dataset, bug_id, {"signature_method_map": signature_method_map,
+                                                    "methods_tests_map": methods_tests_map,
+                                                    "method_test_path_map": method_test_path_map},
+                                  get_extractor_version())
+
+
+def has_prepare_info(dataset, bug_id):
+    return get_artifact_store().has(dataset, bug_id, list(PREPARE_ARTIFACTS), get_extractor_version())
 
 
 def load_signature_method_map(dataset, bug_id):
-    dir_path = os.path.join(ANALYSIS_DIR, dataset, bug_id)
-    if os.path.exists(os.path.join(dir_path, 'signature_method_map.pickle')):
-        with open(os.path.join(dir_path, 'signature_method_map.pickle'), 'rb') as file:
-            return pickle.load(file)
-    else:
-        return {}
+    return get_artifact_store().get(dataset, bug_id, "signature_method_map", get_extractor_version(), {})
 
 
 def get_time():
@@ -358,79 +610,116 @@ def get_time():
 
 
 def load_method_test_path_map(dataset, bug_id):
-    dir_path = os.path.join(ANALYSIS_DIR, dataset, bug_id)
-    if os.path.exists(os.path.join(dir_path, 'method_test_path_map.pickle')):
-        with open(os.path.join(dir_path, 'method_test_path_map.pickle'), 'rb') as file:
-            return pickle.load(file)
-    else:
-        return {}
+    return get_artifact_store().get(dataset, bug_id, "method_test_path_map", get_extractor_version(), {})
 
 
 def load_prepare_info(dataset, bug_id):
-    dir_path = os.path.join(ANALYSIS_DIR, dataset, bug_id)
-    # with open(os.path.join(dir_path, 'initial_failing_tests.pickle'), 'rb') as file:
-    #     failed_tests = pickle.load(file)
-    with open(os.path.join(dir_path, 'signature_method_map.pickle'), 'rb') as file:
-        signature_method_map = pickle.load(file)
-    with open(os.path.join(dir_path, 'methods_tests_map.pickle'), 'rb') as file:
-        methods_tests_map = pickle.load(file)
-    with open(os.path.join(dir_path, 'method_test_path_map.pickle'), 'rb') as file:
-        method_test_path_map = pickle.load(file)
-    return  signature_method_map, methods_tests_map, method_test_path_map
-
-
-def cal_token(*args):
-    lenth = 0
-    for v in args:
-        if isinstance(v, int):
-            lenth += v * 2
-        elif isinstance(v, str):
-            lenth += len(v)
-        elif isinstance(v, list) and isinstance(v[0], dict):
-            lenth += sum([len(vd["content"]) for vd in v])
-        elif isinstance(v, list) and isinstance(v[0], dict):
-            lenth += sum([cal_token(vd) for vd in v])
-    return lenth // 2
+    return tuple(get_artifact_store().get(dataset, bug_id, artifact, get_extractor_version())
+                 for artifact in PREPARE_ARTIFACTS)
 
 
 def get_test_code(working_dir, test_source_dir, test_class, test_method):
     if test_cases_codes_map.get(f"{test_class}::{test_method}") is None:
         # test_source_dir = "test"
-        test_file = os.path.join(working_dir, test_source_dir, "/".join(test_class.split(".")) + ".java")
-        codes = get_method_code(test_file, test_method)
+        # Nested test classes (e.g., FooTest$Nested) are declared in the file of their top-level class
+        class_names = test_class.split("$")
+        test_file = os.path.join(working_dir, test_source_dir, "/".join(class_names[0].split(".")) + ".java")
+        class_chain = tuple([class_names[0].split(".")[-1]] + [name for name in class_names[1:] if not name.isdigit()])
+        codes = get_method_code(test_file, test_method, class_chain=class_chain)
         test_cases_codes_map[f"{test_class}::{test_method}"] = codes
     return test_cases_codes_map.get(f"{test_class}::{test_method}")
 
 
-def get_method_code(file_path, method_name, including_line=-1):
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        java_code = f.read()
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        data = f.readlines()
-    start_line, end_line = get_method_position(java_code, method_name, including_line)
-    code_snippet = ""
-    for i in range(start_line - 1, end_line):
-        code_snippet += data[i]
-    return code_snippet
+def get_method_code(file_path, method_name, including_line=-1, class_chain=None):
+    data, methods = get_java_file_index(file_path)
+    position = locate_method(methods, method_name, including_line, class_chain)
+    if position is None:
+        position = get_method_position("".join(data), method_name, including_line)
+    start_line, end_line = position
+    return "".join(data[start_line - 1:end_line])
+
 
+def get_java_file_index(file_path):
+    # The modification time is part of the cache key, so that modified files are parsed again
+    return parse_java_file(file_path, os.stat(file_path).st_mtime_ns)
 
-def get_method_position_working(queue, java_code, method_name, in_line):
-    jvm_path = jpype.getDefaultJVMPath()
-    javaparser_path = os.path.join(".", "java_lib", "context-extractor.jar")
-    jpype.startJVM(jvm_path, "-ea", "-Djava.class.path=%s" % javaparser_path)
+
+@lru_cache(maxsize=64)
+def parse_java_file(file_path, mtime):
+    """
+        Parses a java file once, returns its lines and an index from each method name to a list of
+        (class_chain, start_line, end_line), where class_chain is the tuple of the names of the enclosing classes.
+        The index is None if the file can not be parsed.
+    """
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        data = f.readlines()
+    try:
+        tokens = list(javalang.tokenizer.tokenize("".join(data)))
+        tree = javalang.parser.Parser(tokens).parse()
+    except (javalang.parser.JavaSyntaxError, javalang.tokenizer.LexerError, StopIteration):
+        return data, None
+    token_indexes = {token.position: i for i, token in enumerate(tokens)}
+    methods = {}
+    for path, node in tree:
+        if not isinstance(node, (javalang.tree.MethodDeclaration, javalang.tree.ConstructorDeclaration)):
+            continue
+        if node.position is None or token_indexes.get(node.position) is None:
+            continue
+        class_chain = tuple(ancestor.name for ancestor in path if isinstance(
+            ancestor, (javalang.tree.ClassDeclaration, javalang.tree.InterfaceDeclaration,
+                       javalang.tree.EnumDeclaration, javalang.tree.AnnotationDeclaration)))
+        # The position of a declaration is after its annotations, which belong to the method as well
+        start_line = min([node.position.line] + [annotation.position.line for annotation in node.annotations
+                                                 if annotation.position is not None])
+        end_line = find_method_end_line(tokens, token_indexes.get(node.position))
+        if end_line is not None:
+            methods.setdefault(node.name, []).append((class_chain, start_line, end_line))
+    return data, methods
+
+
+def find_method_end_line(tokens, begin_index):
+    # The body is the first brace outside parentheses (annotation values may contain braces), abstract methods end at ;
+    paren_depth = 0
+    brace_depth = 0
+    for token in tokens[begin_index:]:
+        if not isinstance(token, javalang.tokenizer.Separator):
+            continue
+        if token.value == '(':
+            paren_depth += 1
+        elif token.value == ')':
+            paren_depth -= 1
+        elif paren_depth > 0:
+            continue
+        elif token.value == ';' and brace_depth == 0:
+            return token.position.line
+        elif token.value == '{':
+            brace_depth += 1
+        elif token.value == '}':
+            brace_depth -= 1
+            if brace_depth == 0:
+                return token.position.line
+    return None
+
+
+def locate_method(methods, method_name, including_line=-1, class_chain=None):
+    if methods is None or methods.get(method_name) is None:
+        return None
+    candidates = methods.get(method_name)
+    if class_chain is not None:
+        candidates = [candidate for candidate in candidates if candidate[0] == class_chain] or candidates
+    if including_line > 0:
+        candidates = [candidate for candidate in candidates if candidate[1] <= including_line <= candidate[2]]
+    if len(candidates) == 0:
+        return None
+    return candidates[0][1], candidates[0][2]
+
+
+def get_method_position_working(java_code, method_name, in_line):
     JClass = jpype.JClass("ProgramAnalysis")
     position = JClass.getMethodPosition(java_code, method_name, in_line)
-    queue.put(str(position))
-    # Shut down JVM
-    jpype.shutdownJVM()
-    return position
+    return str(position)
 
 
 def get_method_position(java_code, method_name, in_line=-1):
-    queue = multiprocessing.Queue()
-    process = multiprocessing.Process(target=get_method_position_working,
-                                      args=(queue, java_code, method_name, in_line))
-    process.start()
-    process.join()
-    position = queue.get()
+    position = get_analysis_service().call(get_method_position_working, java_code, method_name, in_line)
     return int(position.split(",")[0]), int(position.split(",")[1])